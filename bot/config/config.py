@@ -33,6 +33,95 @@ class Settings(BaseSettings):
 
     # Задержка между запросами к рынку в секундах (мин, макс)
     MARKET_MONITOR_DELAY_SECONDS: Tuple[int, int] = (5, 25)
+    # Потоковый разбор страниц рынка: покупка запускается, как только
+    # подходящий предмет прочитан, не дожидаясь конца ответа. Лоты страницы
+    # не сравниваются между собой по оценке "score": баланс достаётся
+    # подходящим лотам в порядке страницы
+    MARKET_STREAM_PARSE: bool = False
+
+    # Общий для всех сессий (и процессов) реестр покупок: лот покупает только
+    # сессия, первой захватившая его. Захват истекает через TTL секунд
+    PURCHASE_CLAIMS: bool = True
+    PURCHASE_CLAIM_TTL: int = 120
+
+    # Общие для всех сессий квоты фильтров: quantity считается на весь парк
+    # аккаунтов, а не на каждую сессию. Единица квоты, владелец которой молчит
+    # дольше QUOTA_LEASE_TTL секунд, передаётся другой сессии
+    GLOBAL_FILTER_QUOTAS: bool = False
+    QUOTA_LEASE_TTL: int = 300
+
+    # Интервал фоновой сверки локального баланса с сервером (в секундах)
+    BALANCE_SYNC_INTERVAL: int = 600
+    # Интервал фоновой догрузки истории покупок (в секундах)
+    HISTORY_SYNC_INTERVAL: int = 1800
+
+    # Локальное хранилище наблюдений рынка (SQLite) для аналитики цен
+    MARKET_OBSERVATIONS: bool = False
+    MARKET_OBSERVATIONS_RETENTION_DAYS: int = 90
+
+    # Скетчи квантилей цен по (тип, редкость, характеристика, уровень) для
+    # фильтров с max_price_quantile. Сохраняются между перезапусками
+    PRICE_QUANTILES: bool = True
+
+    # Выбор характеристики для серверного фильтра (statistic) по наблюдаемой
+    # редкости: запрос строится по самой редкой из required_stats
+    QUERY_PLANNER: bool = True
+
+    # Стратегия сканирования рынка: filter — запрос на каждый фильтр,
+    # superset — один широкий запрос (все типы и редкости, по цене) с
+    # локальной проверкой всех фильтров, auto — выбор по стоимости
+    # (запросов на найденное совпадение)
+    SCAN_STRATEGY: str = 'filter'
+
+    # Проверка изменений .buy каждые N секунд: фильтры применяются без
+    # перезапуска сессий, прогресс неизменённых фильтров сохраняется.
+    # 0 — отключить
+    BUY_RELOAD_INTERVAL: int = 10
+
+    # Совместное сканирование: сессии, опрашивающие один и тот же запрос,
+    # делят его страницы (общий курсор обхода) вместо того, чтобы
+    # независимо перебирать одни и те же страницы
+    COOPERATIVE_PAGING: bool = False
+
+    # Лента изменений рынка: сравнение каждой страницы с прошлым снимком
+    # запроса и события listing_added / price_changed / listing_gone
+    # (ChangeFeed.subscribe), плюс оборот лотов по запросам
+    MARKET_CHANGE_FEED: bool = False
+    # Сообщение в лог, когда цена лота из ленты снижается хотя бы на столько
+    # процентов (0 — отключено, нужна MARKET_CHANGE_FEED)
+    MARKET_PRICE_DROP_ALERT: float = 0
+
+    # Адаптивная задержка между запросами к рынку вместо
+    # MARKET_MONITOR_DELAY_SECONDS: чаще при потоке новых лотов (не чаще
+    # лимита запросов), реже на спокойном рынке — до ADAPTIVE_POLL_MAX_DELAY
+    # секунд. Включает ленту изменений рынка для подсчёта новых лотов
+    ADAPTIVE_POLLING: bool = False
+    ADAPTIVE_POLL_MAX_DELAY: int = 60
+
+    # Модель поступления лотов по времени суток (по получасам), обучаемая
+    # на хранилище наблюдений (нужен MARKET_OBSERVATIONS): запросы
+    # переносятся в часы, когда ожидаются новые лоты. Сохраняется между
+    # перезапусками; оценка на истории: python -m bot.core.arrival_model
+    ARRIVAL_MODEL: bool = False
+
+    # Лимит запросов к рынку за 60 секунд. При ADAPTIVE_RATE_LIMIT это
+    # начальное значение: лимит растёт, пока запросы проходят, и снижается
+    # после 429, 400 и таймаутов — отдельно для каждого эндпоинта и прокси
+    MARKET_RATE_LIMIT: int = 25
+    ADAPTIVE_RATE_LIMIT: bool = True
+
+    # Подбор page_size запросов к рынку: больше лотов за запрос из лимита,
+    # пока задержка ответа не превышает MARKET_PAGE_LATENCY_TARGET секунд.
+    # Размер кратен 20 и не больше MARKET_PAGE_SIZE_MAX
+    ADAPTIVE_PAGE_SIZE: bool = False
+    MARKET_PAGE_SIZE_MAX: int = 100
+    MARKET_PAGE_LATENCY_TARGET: float = 1.5
+
+    # Дублирующие запросы к рынку и истории покупок: если ответ не пришёл
+    # за время 90-го перцентиля задержки, тот же GET отправляется через
+    # другой рабочий прокси группы аккаунтов (общий файл фильтров);
+    # используется первый ответ. Дубли расходуют лимит запросов
+    HEDGED_REQUESTS: bool = False
 
     @property
     def blacklisted_sessions(self) -> List[str]:
@@ -0,0 +1,294 @@
+import asyncio
+import bisect
+import json
+import os
+import sys
+from time import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from bot.config import settings
+from bot.utils import DATA_PATH, logger
+from bot.utils.observation_store import ObservationStore, get_observation_store
+
+
+BUCKET_SECONDS = 1800
+BUCKETS_PER_DAY = 86400 // BUCKET_SECONDS
+# First sightings right after polling resumes are listings that were
+# already on the market, not arrivals
+RESUME_GAP_SECONDS = 1800
+WARMUP_SECONDS = 600
+TRAIN_INTERVAL_SECONDS = 3600
+# Weight of the all-day mean in a bucket's estimate, in observed days
+PRIOR_DAYS = 2.0
+# Polling speeds up one bucket before a predicted burst
+LEAD_BUCKETS = 1
+MIN_DELAY_FACTOR = 0.25
+MAX_DELAY_FACTOR = 4.0
+
+Group = Tuple[str, str]
+
+
+def _slot(at: float) -> int:
+    return int(at // BUCKET_SECONDS)
+
+
+def _resumes(times: Iterable[float]) -> List[float]:
+    # Moments polling started again after a pause
+    resumes = []
+    previous = None
+    for at in times:
+        if previous is None or at - previous > RESUME_GAP_SECONDS:
+            resumes.append(at)
+        previous = at
+    return resumes
+
+
+def arrivals_from_history(rows: Iterable[Tuple[int, str, str]],
+                          poll_minutes: Iterable[int] = (), since: float = 0
+                          ) -> Tuple[Dict[int, Dict[Group, int]], Set[int]]:
+    # rows: (first_seen, type, rarity) ordered by first_seen; history from
+    # before `since` was counted already and only tells whether polling was
+    # running. Without recorded polls (older stores) first sightings stand in
+    # for them, which misses quiet stretches of a sparse market
+    rows = list(rows)
+    poll_times = [minute * 60 for minute in poll_minutes]
+    if not poll_times:
+        poll_times = [row[0] for row in rows]
+    resumes = _resumes(poll_times)
+    active = {_slot(at) for at in poll_times if at >= since}
+    arrivals: Dict[int, Dict[Group, int]] = {}
+    for first_seen, equipment_type, rarity in rows:
+        if first_seen < since:
+            continue
+        index = bisect.bisect_right(resumes, first_seen) - 1
+        if index >= 0 and first_seen < resumes[index] + WARMUP_SECONDS:
+            continue
+        counts = arrivals.setdefault(_slot(first_seen), {})
+        group = (equipment_type, rarity)
+        counts[group] = counts.get(group, 0) + 1
+    return arrivals, active
+
+
+class ArrivalModel:
+    def __init__(self, path: Optional[str] = None):
+        self._path = path
+        # slot (half hour since epoch) -> (type, rarity) -> new listings
+        self._arrivals: Dict[int, Dict[Group, int]] = {}
+        # Slots in which the bot was polling the market
+        self._active: Set[int] = set()
+        self.trained_until = 0.0
+        self._profiles: Dict[Tuple, List[float]] = {}
+        self._factors: Dict[Tuple, List[float]] = {}
+        self._trainer: Optional[asyncio.Task] = None
+        if path:
+            self.load()
+
+    def record_activity(self, at: Optional[float] = None) -> None:
+        slot = _slot(at if at is not None else time())
+        if slot not in self._active:
+            self._active.add(slot)
+            self._profiles.clear()
+            self._factors.clear()
+
+    def add_history(self, rows: Iterable[Tuple[int, str, str]],
+                    poll_minutes: Iterable[int] = ()) -> None:
+        self.merge(*arrivals_from_history(rows, poll_minutes))
+
+    def merge(self, arrivals: Dict[int, Dict[Group, int]],
+              active: Set[int]) -> None:
+        for slot, counts in arrivals.items():
+            target = self._arrivals.setdefault(slot, {})
+            for group, count in counts.items():
+                target[group] = target.get(group, 0) + count
+        self._active.update(active)
+        self._profiles.clear()
+        self._factors.clear()
+
+    def prune(self, retention_days: int) -> None:
+        oldest = _slot(time() - retention_days * 86400)
+        self._arrivals = {s: c for s, c in self._arrivals.items() if s >= oldest}
+        self._active = {s for s in self._active if s >= oldest}
+        self._profiles.clear()
+        self._factors.clear()
+
+    @staticmethod
+    def _matches(group: Group, equipment_type: str,
+                 rarity: Optional[str]) -> bool:
+        return ((equipment_type in ('*', None) or group[0] == equipment_type)
+                and (not rarity or group[1] == rarity))
+
+    def profile(self, groups: Iterable[Tuple[str, Optional[str]]]
+                ) -> Optional[List[float]]:
+        # Expected new listings per second for each bucket of the day
+        groups = tuple(sorted(set(groups), key=str))
+        cached = self._profiles.get(groups)
+        if cached is not None or not self._active:
+            return cached
+        counts = [0.0] * BUCKETS_PER_DAY
+        days = [0] * BUCKETS_PER_DAY
+        for slot in self._active:
+            bucket = slot % BUCKETS_PER_DAY
+            days[bucket] += 1
+            counts[bucket] += sum(
+                count for group, count in self._arrivals.get(slot, {}).items()
+                if any(self._matches(group, t, r) for t, r in groups))
+        mean = sum(counts) / sum(days)
+        profile = [(counts[b] + PRIOR_DAYS * mean) /
+                   ((days[b] + PRIOR_DAYS) * BUCKET_SECONDS)
+                   for b in range(BUCKETS_PER_DAY)]
+        self._profiles[groups] = profile
+        return profile
+
+    def rate(self, groups: Iterable[Tuple[str, Optional[str]]],
+             at: Optional[float] = None) -> Optional[float]:
+        profile = self.profile(groups)
+        if profile is None:
+            return None
+        return profile[_slot(at if at is not None else time()) %
+                       BUCKETS_PER_DAY]
+
+    def delay_factor(self, groups: Iterable[Tuple[str, Optional[str]]],
+                     at: Optional[float] = None) -> float:
+        # Below 1 in and just before predicted bursts, above 1 elsewhere;
+        # the mean of 1 / factor over the day is 1, so the day's request
+        # budget is moved, not increased
+        groups = tuple(sorted(set(groups), key=str))
+        factors = self._factors.get(groups)
+        if factors is None:
+            profile = self.profile(groups)
+            mean = sum(profile) / len(profile) if profile else 0
+            if mean <= 0:
+                return 1.0
+            factors = []
+            for bucket in range(BUCKETS_PER_DAY):
+                ahead = max(profile[(bucket + lead) % BUCKETS_PER_DAY]
+                            for lead in range(LEAD_BUCKETS + 1))
+                factors.append(min(max(mean / ahead, MIN_DELAY_FACTOR),
+                                   MAX_DELAY_FACTOR))
+            scale = sum(1 / factor for factor in factors) / len(factors)
+            factors = [factor * scale for factor in factors]
+            self._factors[groups] = factors
+        return factors[_slot(at if at is not None else time()) %
+                       BUCKETS_PER_DAY]
+
+    @staticmethod
+    def _read_history(store: ObservationStore, since: float, until: float
+                      ) -> Tuple[Dict[int, Dict[Group, int]], Set[int]]:
+        # Runs in a worker thread: reads and aggregates, the model itself is
+        # only changed on the event loop
+        rows = store.first_seen_times(since - RESUME_GAP_SECONDS)
+        minutes = store.poll_minutes(since - RESUME_GAP_SECONDS)
+        return arrivals_from_history(
+            (row for row in rows if row[0] < until),
+            (minute for minute in minutes if minute * 60 < until), since)
+
+    async def train(self, store: ObservationStore) -> None:
+        # Listings first seen in the current slot can still arrive; only
+        # closed slots are read
+        until = _slot(time()) * BUCKET_SECONDS
+        if until <= self.trained_until:
+            return
+        self.merge(*await asyncio.to_thread(self._read_history, store,
+                                            self.trained_until, until))
+        self.trained_until = until
+        self.prune(settings.MARKET_OBSERVATIONS_RETENTION_DAYS)
+
+    def ensure_training(self, store: ObservationStore) -> None:
+        if self._trainer is None or self._trainer.done():
+            self._trainer = asyncio.create_task(self._run_training(store))
+
+    async def _run_training(self, store: ObservationStore) -> None:
+        while True:
+            try:
+                await self.train(store)
+                await asyncio.to_thread(self.save, self._snapshot())
+            except Exception as e:
+                logger.warning(f"Не удалось обновить модель поступления "
+                               f"лотов: {e}")
+            await asyncio.sleep(TRAIN_INTERVAL_SECONDS)
+
+    def _snapshot(self) -> Dict:
+        return {
+            'trained_until': self.trained_until,
+            'active': sorted(self._active),
+            'arrivals': [[slot, group[0], group[1], count]
+                         for slot, counts in self._arrivals.items()
+                         for group, count in counts.items()],
+        }
+
+    def save(self, snapshot: Optional[Dict] = None) -> None:
+        if not self._path:
+            return
+        snapshot = snapshot if snapshot is not None else self._snapshot()
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self._path)
+
+    def load(self) -> None:
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.trained_until = float(snapshot.get('trained_until', 0))
+        self._active = set(snapshot.get('active', []))
+        for slot, equipment_type, rarity, count in snapshot.get('arrivals', []):
+            self._arrivals.setdefault(slot, {})[(equipment_type, rarity)] = count
+
+
+def evaluate(store: ObservationStore, test_days: float = 7) -> str:
+    # Offline check against recorded history: train on everything before the
+    # last test_days, then compare the predicted profile with what arrived
+    rows = store.first_seen_times(0)
+    minutes = store.poll_minutes(0)
+    split = time() - test_days * 86400
+    model = ArrivalModel()
+    model.add_history((row for row in rows if row[0] < split),
+                      (minute for minute in minutes if minute * 60 < split))
+    test_arrivals, test_active = arrivals_from_history(
+        rows, minutes, split)
+    profile = model.profile([('*', None)])
+    if profile is None or not test_active:
+        return "Недостаточно истории для оценки модели"
+
+    mean = sum(profile) / len(profile)
+    model_error = flat_error = 0.0
+    total = in_top = 0
+    top = set(sorted(range(BUCKETS_PER_DAY), key=lambda b: profile[b],
+                     reverse=True)[:BUCKETS_PER_DAY // 4])
+    for slot in test_active:
+        actual = sum(test_arrivals.get(slot, {}).values())
+        bucket = slot % BUCKETS_PER_DAY
+        model_error += abs(profile[bucket] * BUCKET_SECONDS - actual)
+        flat_error += abs(mean * BUCKET_SECONDS - actual)
+        total += actual
+        if bucket in top:
+            in_top += actual
+    slots = len(test_active)
+    return (f"Интервалов в тесте: {slots}, новых лотов: {total}. Средняя "
+            f"ошибка на {BUCKET_SECONDS // 60} мин: модель "
+            f"{model_error / slots:.2f}, равномерный прогноз "
+            f"{flat_error / slots:.2f}. В 25% самых активных по прогнозу "
+            f"интервалов пришло {in_top / max(total, 1):.0%} лотов")
+
+
+_model: Optional[ArrivalModel] = None
+
+
+def get_arrival_model() -> Optional[ArrivalModel]:
+    global _model
+    if not settings.ARRIVAL_MODEL or not settings.MARKET_OBSERVATIONS:
+        return None
+    if _model is None:
+        _model = ArrivalModel(os.path.join(DATA_PATH, 'arrival_model.json'))
+    return _model
+
+
+if __name__ == '__main__':
+    # python -m bot.core.arrival_model [дней в тесте]
+    store = get_observation_store()
+    if store is None:
+        print("Нужен MARKET_OBSERVATIONS=True и записанная история рынка")
+        sys.exit(1)
+    print(evaluate(store, float(sys.argv[1]) if len(sys.argv) > 1 else 7))
@@ -0,0 +1,76 @@
+import asyncio
+from time import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class BalanceLedger:
+    def __init__(self, log_method):
+        self._log = log_method
+        self._balance: Optional[float] = None
+        self._synced_at = 0.0
+        # market_equipment_id -> price of buys queued or in flight
+        self._reserved: Dict[str, float] = {}
+        self._debits: List[Tuple[float, float]] = []
+        self._sync_requested = asyncio.Event()
+
+    @property
+    def balance(self) -> Optional[float]:
+        return self._balance
+
+    @property
+    def available(self) -> Optional[float]:
+        if self._balance is None:
+            return None
+        return self._balance - sum(self._reserved.values())
+
+    def can_afford(self, price: float) -> bool:
+        available = self.available
+        return available is None or price <= available
+
+    def try_reserve(self, market_equipment_id: str, price: float) -> bool:
+        if not self.can_afford(price):
+            return False
+        self._reserved[market_equipment_id] = price
+        return True
+
+    def settle(self, market_equipment_id: str, bought: bool,
+               attempted: bool = True) -> None:
+        price = self._reserved.pop(market_equipment_id, None)
+        if price is None:
+            return
+        if bought:
+            self._debits.append((time(), price))
+            if self._balance is not None:
+                self._balance -= price
+        elif attempted:
+            # A failed buy is often a stale balance: re-sync early
+            self._sync_requested.set()
+
+    def apply_sync(self, balance: float, requested_at: float) -> None:
+        # Buys settled after the request was sent may be missing from the
+        # server value; keep them debited until the next sync confirms
+        late_debits = sum(price for at, price in self._debits
+                          if at >= requested_at)
+        self._balance = balance - late_debits
+        self._debits = [(at, price) for at, price in self._debits
+                        if at >= requested_at]
+        self._synced_at = time()
+        if late_debits:
+            self._sync_requested.set()
+
+    async def run_sync(self, fetch_balance: Callable[[], Awaitable[Optional[float]]],
+                       interval: float) -> None:
+        # fetch_balance has to send its request right away: buys settled
+        # before requested_at are taken as included in the server balance
+        while True:
+            requested_at = time()
+            balance = await fetch_balance()
+            self._sync_requested.clear()
+            if balance is not None:
+                self.apply_sync(balance, requested_at)
+                self._log('debug', f"Баланс синхронизирован: "
+                                   f"{self._balance:.2f} TOK", 'balance')
+            try:
+                await asyncio.wait_for(self._sync_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
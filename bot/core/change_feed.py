@@ -0,0 +1,229 @@
+import asyncio
+from collections import deque
+from time import time
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Optional, Set
+
+from bot.config import settings
+from bot.utils import logger
+
+
+LISTING_ADDED = 'listing_added'
+PRICE_CHANGED = 'price_changed'
+LISTING_GONE = 'listing_gone'
+EVENT_KINDS = (LISTING_ADDED, PRICE_CHANGED, LISTING_GONE)
+
+SUBSCRIPTION_QUEUE_SIZE = 1000
+# Listings not seen for this long are dropped from the snapshot without an
+# event (their pages are no longer polled)
+SNAPSHOT_TTL_SECONDS = 6 * 3600
+TURNOVER_WINDOW_SECONDS = 900
+
+
+class MarketEvent:
+    __slots__ = ('kind', 'query_key', 'page', 'market_equipment_id', 'item',
+                 'price_tok', 'old_price_tok', 'at', 'initial')
+
+    def __init__(self, kind: str, query_key: Hashable, page: int,
+                 market_equipment_id: str, item: Optional[Dict],
+                 price_tok: Optional[float], old_price_tok: Optional[float],
+                 at: float, initial: bool = False):
+        self.kind = kind
+        self.query_key = query_key
+        self.page = page
+        self.market_equipment_id = market_equipment_id
+        # The listing as last returned by the server (None for listing_gone)
+        self.item = item
+        self.price_tok = price_tok
+        self.old_price_tok = old_price_tok
+        self.at = at
+        # Listed before the page was first polled, not a new arrival
+        self.initial = initial
+
+    def __repr__(self) -> str:
+        return (f"MarketEvent({self.kind}, {self.market_equipment_id}, "
+                f"{self.old_price_tok} -> {self.price_tok})")
+
+
+class Subscription:
+    def __init__(self, feed: 'ChangeFeed', kinds: FrozenSet[str]):
+        self._feed = feed
+        self.kinds = kinds
+        self._queue: asyncio.Queue = asyncio.Queue(SUBSCRIPTION_QUEUE_SIZE)
+        self.dropped = 0
+
+    def put(self, event: MarketEvent) -> None:
+        # The fetch stage never waits for a slow subscriber: the oldest
+        # event is dropped instead
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(event)
+
+    def close(self) -> None:
+        self._feed.unsubscribe(self)
+
+    def __aiter__(self) -> 'Subscription':
+        return self
+
+    async def __anext__(self) -> MarketEvent:
+        return await self._queue.get()
+
+
+class _Listing:
+    __slots__ = ('price_tok', 'page', 'seen_at')
+
+    def __init__(self, price_tok: float, page: int, seen_at: float):
+        self.price_tok = price_tok
+        self.page = page
+        self.seen_at = seen_at
+
+
+class _QuerySnapshot:
+    __slots__ = ('listings', 'page_visits', 'events')
+
+    def __init__(self):
+        self.listings: Dict[str, _Listing] = {}
+        # page -> time of its last visit
+        self.page_visits: Dict[int, float] = {}
+        # (time, kind) of recent events, for turnover
+        self.events: deque = deque()
+
+
+class ChangeFeed:
+    def __init__(self):
+        self._snapshots: Dict[Hashable, _QuerySnapshot] = {}
+        self._subscriptions: List[Subscription] = []
+        self._price_alerts: Optional[asyncio.Task] = None
+
+    def subscribe(self, kinds: Optional[Iterable[str]] = None) -> Subscription:
+        subscription = Subscription(self, frozenset(kinds or EVENT_KINDS))
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def observe(self, query_key: Hashable, page: int,
+                items: List[Dict]) -> List[MarketEvent]:
+        now = time()
+        snapshot = self._snapshots.setdefault(query_key, _QuerySnapshot())
+        events = []
+        initial = page not in snapshot.page_visits
+        on_page: Set[str] = set()
+        for item in items:
+            market_equipment_id = str(item.get('id'))
+            price_tok = float(item.get('price_gross', 0)) / 1_000_000_000
+            on_page.add(market_equipment_id)
+            listing = snapshot.listings.get(market_equipment_id)
+            if listing is None:
+                snapshot.listings[market_equipment_id] = _Listing(price_tok,
+                                                                  page, now)
+                events.append(MarketEvent(LISTING_ADDED, query_key, page,
+                                          market_equipment_id, item,
+                                          price_tok, None, now, initial))
+                continue
+            if listing.price_tok != price_tok:
+                events.append(MarketEvent(PRICE_CHANGED, query_key, page,
+                                          market_equipment_id, item,
+                                          price_tok, listing.price_tok, now))
+                listing.price_tok = price_tok
+            listing.page = page
+            listing.seen_at = now
+        snapshot.page_visits[page] = now
+        events.extend(self._gone(snapshot, query_key, page, on_page, now))
+        while snapshot.events and \
+                snapshot.events[0][0] < now - TURNOVER_WINDOW_SECONDS:
+            snapshot.events.popleft()
+
+        for event in events:
+            if not event.initial:
+                snapshot.events.append((now, event.kind))
+            for subscription in self._subscriptions:
+                if event.kind in subscription.kinds:
+                    subscription.put(event)
+        return events
+
+    @staticmethod
+    def _gone(snapshot: _QuerySnapshot, query_key: Hashable, page: int,
+              on_page: Set[str], now: float) -> List[MarketEvent]:
+        # Listings shift to the next page when cheaper ones are added, so a
+        # listing missing from its page is gone only if the next page, polled
+        # after it, does not have it either (or the next page is never polled)
+        events = []
+        visits = snapshot.page_visits
+        for market_equipment_id, listing in list(snapshot.listings.items()):
+            if market_equipment_id in on_page:
+                continue
+            if now - listing.seen_at > SNAPSHOT_TTL_SECONDS:
+                del snapshot.listings[market_equipment_id]
+                continue
+            if listing.page == page - 1:
+                missed = visits.get(listing.page, 0) > listing.seen_at
+            elif listing.page == page:
+                missed = page + 1 not in visits
+            else:
+                continue
+            if not missed:
+                continue
+            del snapshot.listings[market_equipment_id]
+            events.append(MarketEvent(LISTING_GONE, query_key, listing.page,
+                                      market_equipment_id, None, None,
+                                      listing.price_tok, now))
+        return events
+
+    def ensure_price_alerts(self, min_drop_percent: float) -> None:
+        # One consumer per process: the sessions share the feed
+        if self._price_alerts is None or self._price_alerts.done():
+            self._price_alerts = asyncio.create_task(
+                self._alert_price_drops(min_drop_percent))
+
+    async def _alert_price_drops(self, min_drop_percent: float) -> None:
+        subscription = self.subscribe((PRICE_CHANGED,))
+        try:
+            async for event in subscription:
+                if not event.old_price_tok or \
+                        event.price_tok >= event.old_price_tok:
+                    continue
+                drop = 1 - event.price_tok / event.old_price_tok
+                if drop * 100 < min_drop_percent:
+                    continue
+                name = (event.item or {}).get('metadata', {}).get(
+                    'equipment', {}).get('name', '???')
+                logger.info(f"Цена снижена на {drop:.0%}: {name} "
+                            f"[market_id:{event.market_equipment_id}] "
+                            f"{event.old_price_tok:.1f} → "
+                            f"{event.price_tok:.1f} TOK")
+        finally:
+            subscription.close()
+
+    def turnover(self, query_key: Hashable) -> Dict[str, float]:
+        # Events per minute over the recent window
+        snapshot = self._snapshots.get(query_key)
+        if snapshot is None:
+            return {kind: 0.0 for kind in EVENT_KINDS}
+        cutoff = time() - TURNOVER_WINDOW_SECONDS
+        while snapshot.events and snapshot.events[0][0] < cutoff:
+            snapshot.events.popleft()
+        minutes = TURNOVER_WINDOW_SECONDS / 60
+        return {kind: sum(1 for _, k in snapshot.events if k == kind) / minutes
+                for kind in EVENT_KINDS}
+
+    def summary(self, query_key: Hashable) -> str:
+        rates = self.turnover(query_key)
+        return (f"новых {rates[LISTING_ADDED]:.1f}/мин, изменений цены "
+                f"{rates[PRICE_CHANGED]:.1f}/мин, снято "
+                f"{rates[LISTING_GONE]:.1f}/мин")
+
+
+_feed: Optional[ChangeFeed] = None
+
+
+def get_change_feed() -> Optional[ChangeFeed]:
+    global _feed
+    # Adaptive polling measures arrivals through the feed
+    if not (settings.MARKET_CHANGE_FEED or settings.ADAPTIVE_POLLING):
+        return None
+    if _feed is None:
+        _feed = ChangeFeed()
+    return _feed
@@ -0,0 +1,307 @@
+import json
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+class ItemView:
+    # Listing fields every compiled filter needs, prepared once per listing
+    __slots__ = ('item', 'stats', 'price', '_levels')
+
+    def __init__(self, item: Dict, price_tok: float):
+        self.item = item
+        self.stats = item.get('metadata', {}).get('equipment', {}).get(
+            'equipment_stats', [])
+        self.price = price_tok
+        self._levels: Optional[Dict[str, List[int]]] = None
+
+    @property
+    def levels(self) -> Dict[str, List[int]]:
+        # stat type -> levels, highest first
+        if self._levels is None:
+            levels: Dict[str, List[int]] = {}
+            for stat in self.stats:
+                levels.setdefault(stat.get('type'), []).append(
+                    int(stat.get('level', 0)))
+            for same_type in levels.values():
+                same_type.sort(reverse=True)
+            self._levels = levels
+        return self._levels
+
+    def value_sum(self, stat_types: FrozenSet[str]) -> float:
+        return sum(float(stat.get('value') or 0) for stat in self.stats
+                   if stat.get('type') in stat_types)
+
+
+# A compiled node returns None when the listing does not match, otherwise
+# how far it exceeds the requirement (stat levels above the minimums)
+Node = Callable[[ItemView], Optional[float]]
+
+
+def _compile_stats(requirements: List[Tuple[str, int]]) -> Node:
+    # Each requirement needs its own stat slot. Matching the highest levels
+    # of a type against the highest minimums of that type is optimal
+    by_type: Dict[str, List[int]] = {}
+    for stat_type, min_level in requirements:
+        by_type.setdefault(stat_type, []).append(min_level)
+    groups = [(stat_type, sorted(mins, reverse=True))
+              for stat_type, mins in by_type.items()]
+
+    if len(requirements) == 1:
+        (only_type, only_min), = requirements
+
+        def single(view: ItemView) -> Optional[float]:
+            best = None
+            for stat in view.stats:
+                if stat.get('type') == only_type:
+                    level = int(stat.get('level', 0))
+                    if level >= only_min and (best is None or level > best):
+                        best = level
+            return None if best is None else best - only_min
+        return single
+
+    def node(view: ItemView) -> Optional[float]:
+        # Collects only the stat types the filter mentions
+        found: Dict[str, List[int]] = {}
+        for stat in view.stats:
+            stat_type = stat.get('type')
+            if stat_type in by_type:
+                found.setdefault(stat_type, []).append(int(stat.get('level', 0)))
+        surplus = 0
+        for stat_type, mins in groups:
+            levels = found.get(stat_type)
+            if not levels or len(levels) < len(mins):
+                return None
+            if len(levels) > 1:
+                levels.sort(reverse=True)
+            for level, min_level in zip(levels, mins):
+                if level < min_level:
+                    return None
+                surplus += level - min_level
+        return surplus
+    return node
+
+
+def _points(weights: Dict[str, float],
+            level_weights: Dict[int, float]) -> Callable[[ItemView], float]:
+    pairs = list(weights.items())
+
+    def points(view: ItemView) -> float:
+        total = 0.0
+        for stat_type, weight in pairs:
+            for level in view.levels.get(stat_type, ()):
+                total += weight * level_weights.get(level, level)
+        return total
+    return points
+
+
+def _number(expr: Dict, field: str) -> float:
+    try:
+        return float(expr[field])
+    except (KeyError, TypeError, ValueError):
+        raise FilterSyntaxError(f"'{field}' must be a number in {expr}")
+
+
+def _weights(expr: Dict, field: str) -> Dict[str, float]:
+    weights = expr.get(field)
+    if isinstance(weights, list):
+        weights = {stat_type: 1.0 for stat_type in weights}
+    if not isinstance(weights, dict) or not weights:
+        raise FilterSyntaxError(f"'{field}' must list stat types in {expr}")
+    return {str(stat_type): float(weight) for stat_type, weight in weights.items()}
+
+
+def _level_weights(expr: Dict) -> Dict[int, float]:
+    return {int(level): float(weight)
+            for level, weight in (expr.get('level_weights') or {}).items()}
+
+
+def _stat_requirement(expr: Dict) -> List[Tuple[str, int]]:
+    count = int(expr.get('count', 1))
+    return [(str(expr['stat']), int(expr.get('min_level', 0)))] * count
+
+
+def _compile_all(children: List) -> Node:
+    # Stat terms of one AND group share the slot assignment, like the
+    # entries of required_stats
+    requirements = []
+    nodes = []
+    for child in children:
+        if isinstance(child, dict) and 'stat' in child:
+            requirements.extend(_stat_requirement(child))
+        else:
+            nodes.append(_compile_expr(child))
+    if requirements:
+        nodes.insert(0, _compile_stats(requirements))
+
+    def node(view: ItemView) -> Optional[float]:
+        surplus = 0.0
+        for child in nodes:
+            result = child(view)
+            if result is None:
+                return None
+            surplus += result
+        return surplus
+    return node
+
+
+def _compile_any(children: List) -> Node:
+    nodes = [_compile_expr(child) for child in children]
+
+    def node(view: ItemView) -> Optional[float]:
+        best = None
+        for child in nodes:
+            result = child(view)
+            if result is not None and (best is None or result > best):
+                best = result
+        return best
+    return node
+
+
+def _compile_expr(expr) -> Node:
+    if not isinstance(expr, dict):
+        raise FilterSyntaxError(f"Expected an object, got {expr!r}")
+
+    if 'all' in expr or 'any' in expr:
+        children = expr.get('all', expr.get('any'))
+        if not isinstance(children, list) or not children:
+            raise FilterSyntaxError(f"'all'/'any' must be a non-empty list in "
+                                    f"{expr}")
+        return _compile_all(children) if 'all' in expr else \
+            _compile_any(children)
+
+    if 'not' in expr:
+        inner = _compile_expr(expr['not'])
+        return lambda view: 0.0 if inner(view) is None else None
+
+    if 'stat' in expr:
+        return _compile_stats(_stat_requirement(expr))
+
+    if 'points' in expr:
+        points = _points(_weights(expr, 'points'), _level_weights(expr))
+        minimum = _number(expr, 'min')
+
+        def points_node(view: ItemView) -> Optional[float]:
+            total = points(view)
+            return total - minimum if total >= minimum else None
+        return points_node
+
+    if 'sum_value' in expr:
+        stat_types = frozenset(_weights(expr, 'sum_value'))
+        minimum = _number(expr, 'min')
+
+        def sum_node(view: ItemView) -> Optional[float]:
+            return 0.0 if view.value_sum(stat_types) >= minimum else None
+        return sum_node
+
+    if 'price_per_point' in expr:
+        points = _points(_weights(expr, 'price_per_point'),
+                         _level_weights(expr))
+        maximum = _number(expr, 'max')
+
+        def price_node(view: ItemView) -> Optional[float]:
+            total = points(view)
+            return 0.0 if total > 0 and view.price / total <= maximum else None
+        return price_node
+
+    raise FilterSyntaxError(f"Unknown condition {expr}")
+
+
+def _referenced_types(expr) -> List[str]:
+    if isinstance(expr, list):
+        return [t for child in expr for t in _referenced_types(child)]
+    if not isinstance(expr, dict):
+        return []
+    types = [str(expr['stat'])] if 'stat' in expr else []
+    for field in ('points', 'sum_value', 'price_per_point'):
+        if isinstance(expr.get(field), (dict, list)):
+            types.extend(str(t) for t in expr[field])
+    for field in ('all', 'any', 'not'):
+        if field in expr:
+            types.extend(_referenced_types(expr[field]))
+    return types
+
+
+class CompiledFilter:
+    __slots__ = ('equipment_type', 'rarity', 'predicate', 'stat_types')
+
+    def __init__(self, filter_obj: Dict):
+        equipment_type = filter_obj.get('equipment_type', '*')
+        self.equipment_type = None if equipment_type == '*' else equipment_type
+        self.rarity = filter_obj.get('rarity')
+
+        terms = []
+        required_stats = filter_obj.get('required_stats') or []
+        if not isinstance(required_stats, list):
+            raise FilterSyntaxError("'required_stats' must be a list")
+        for stat_filter in required_stats:
+            if not isinstance(stat_filter, dict) or 'type' not in stat_filter:
+                raise FilterSyntaxError(f"Invalid required_stats entry "
+                                        f"{stat_filter!r}")
+            terms.append({'stat': stat_filter['type'],
+                          'min_level': stat_filter.get('min_level', 0)})
+        if 'match' in filter_obj:
+            terms.append(filter_obj['match'])
+        self.predicate: Node = _compile_all(terms) if terms else \
+            (lambda view: 0.0)
+        self.stat_types: FrozenSet[str] = frozenset(_referenced_types(terms))
+
+    def accepts_kind(self, item: Dict) -> bool:
+        # Checked on the raw listing, before the view is built
+        if self.equipment_type is not None and \
+                item.get('equipment_type') != self.equipment_type:
+            return False
+        if self.rarity:
+            rarity = item.get('rarity') or item.get('metadata', {}).get(
+                'equipment', {}).get('rarity')
+            return rarity == self.rarity
+        return True
+
+
+# Compiled filters by content, shared by every session and by reloads
+_compiled: Dict[str, CompiledFilter] = {}
+# id(filter dict) -> (filter dict, compiled) for the per-item lookup; every
+# session holds its own copies of the filter dicts
+_by_id: Dict[int, Tuple[Dict, CompiledFilter]] = {}
+BY_ID_LIMIT = 100_000
+
+
+def _content_key(filter_obj: Dict) -> str:
+    return json.dumps({k: filter_obj.get(k) for k in
+                       ('equipment_type', 'rarity', 'required_stats', 'match')},
+                      sort_keys=True)
+
+
+def _check_tuning(filter_obj: Dict) -> None:
+    # Read with float() on every scan and every candidate, so a bad value
+    # is rejected with the file instead
+    if 'priority' in filter_obj:
+        _number(filter_obj, 'priority')
+    score = filter_obj.get('score')
+    if score is None:
+        return
+    if not isinstance(score, dict):
+        raise FilterSyntaxError(f"'score' must be an object in {filter_obj}")
+    for field in ('price_weight', 'stat_weight', 'hours'):
+        if field in score:
+            _number(score, field)
+    if score.get('reference', 'quantile') not in ('quantile', 'max_price'):
+        raise FilterSyntaxError(f"'reference' must be 'quantile' or "
+                                f"'max_price' in {score}")
+
+
+def compile_filter(filter_obj: Dict) -> CompiledFilter:
+    entry = _by_id.get(id(filter_obj))
+    if entry is not None and entry[0] is filter_obj:
+        return entry[1]
+    _check_tuning(filter_obj)
+    key = _content_key(filter_obj)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compiled[key] = CompiledFilter(filter_obj)
+    if len(_by_id) >= BY_ID_LIMIT:
+        _by_id.clear()
+    _by_id[id(filter_obj)] = (filter_obj, compiled)
+    return compiled
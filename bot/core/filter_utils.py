@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from bot.core.filter_dsl import FilterSyntaxError, compile_filter
+
+
+# Fields that tune a filter without changing which listings it is after:
+# editing them keeps the filter's purchase progress
+TUNING_FIELDS = ('quantity', 'max_price_tok', 'max_price_quantile',
+                 'priority', 'score')
+NON_IDENTITY_FIELDS = ('bought',) + TUNING_FIELDS
+
+
+def filter_key(filter_obj: Dict) -> str:
+    spec = {k: v for k, v in filter_obj.items()
+            if k not in NON_IDENTITY_FIELDS}
+    raw = json.dumps(spec, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def filter_keys(filters: List[Dict]) -> List[str]:
+    # Rules of one file can differ only in tuning fields (price tiers of the
+    # same item): the n-th repeat of an identity gets the suffix -n, so each
+    # keeps its own progress as long as the order of the tiers is kept
+    seen: Dict[str, int] = {}
+    keys = []
+    for filter_obj in filters:
+        key = filter_key(filter_obj)
+        repeat = seen.get(key, 0)
+        seen[key] = repeat + 1
+        keys.append(f"{key}-{repeat}" if repeat else key)
+    return keys
+
+
+# Parsed and compiled filter sets by file content: identical files (and all
+# sessions reading one file) share one copy
+_parsed: Dict[str, List[Dict]] = {}
+_files: Dict[str, 'FilterFile'] = {}
+
+
+def _parse(raw: str) -> List[Dict]:
+    digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    filters = _parsed.get(digest)
+    if filters is not None:
+        return filters
+    filters = json.loads(raw)
+    if not isinstance(filters, list) or not filters:
+        # An empty file is usually an editor in the middle of a save
+        raise FilterSyntaxError("Expected a non-empty list of filters")
+    for filter_obj in filters:
+        if not isinstance(filter_obj, dict):
+            raise FilterSyntaxError(f"Expected a filter object, got "
+                                    f"{filter_obj!r}")
+        compile_filter(filter_obj)
+    _parsed[digest] = filters
+    return filters
+
+
+class FilterFile:
+    def __init__(self, path: str):
+        self.path = path
+        self._signature: Optional[Tuple[int, int]] = None
+        # Shared and never mutated: each FilterManager works on copies
+        self.filters: Optional[List[Dict]] = None
+        self.version = 0
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self) -> bool:
+        # A missing file is treated as unchanged once loaded: editors often
+        # replace the file by deleting and renaming
+        signature = self._stat()
+        if self.filters is not None and (signature is None or
+                                         signature == self._signature):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            raw = f.read()
+        # Remembered before parsing, so an invalid file is not re-read until
+        # the next edit
+        self._signature = signature
+        filters = _parse(raw)
+        if filters is self.filters:
+            return False
+        self.filters = filters
+        self.version += 1
+        return True
+
+
+def buy_file_path(session_config: Dict) -> str:
+    # accounts_config.json: "buy_file" is the session's own file,
+    # "buy_group" a file shared by the group, .buy.<group>
+    if session_config.get('buy_file'):
+        return session_config['buy_file']
+    if session_config.get('buy_group'):
+        return f".buy.{session_config['buy_group']}"
+    return '.buy'
+
+
+def get_filter_file(path: str) -> FilterFile:
+    key = os.path.abspath(path)
+    filter_file = _files.get(key)
+    if filter_file is None:
+        filter_file = _files[key] = FilterFile(path)
+    return filter_file
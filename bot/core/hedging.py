@@ -0,0 +1,217 @@
+import asyncio
+from collections import deque
+from time import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiocfscrape import CloudflareScraper
+from aiohttp_proxy import ProxyConnector
+
+from bot.config import settings
+from bot.core.filter_utils import buy_file_path
+from bot.core.rate_controller import (AimdRateLimiter, congestion_signal,
+                                      get_rate_controller)
+from bot.utils import CONFIG_PATH, config_utils
+
+
+HEDGE_QUANTILE = 0.9
+LATENCY_WINDOW = 200
+# Latencies an endpoint needs before its p90 is trusted
+HEDGE_MIN_SAMPLES = 20
+HEDGE_TIMEOUT_SECONDS = 20
+GROUPS_REFRESH_SECONDS = 300
+# A proxy that failed this many hedges in a row rests for a while
+PROXY_FAILURES_TO_REST = 2
+PROXY_REST_SECONDS = 300
+
+
+class ProxyGroups:
+    # Proxies of the account group: sessions that share a filter file
+    def __init__(self, config_path: str):
+        self._config_path = config_path
+        self._groups: Dict[str, str] = {}
+        self._proxies: Dict[str, List[str]] = {}
+        self._loaded_at = 0.0
+        self._failures: Dict[str, int] = {}
+        self._resting_until: Dict[str, float] = {}
+        self._latency: Dict[str, float] = {}
+
+    def _refresh(self) -> None:
+        now = time()
+        if now - self._loaded_at < GROUPS_REFRESH_SECONDS:
+            return
+        self._loaded_at = now
+        accounts = config_utils.read_config_file(self._config_path) or {}
+        groups: Dict[str, str] = {}
+        proxies: Dict[str, List[str]] = {}
+        for session_name, session_config in accounts.items():
+            if not isinstance(session_config, dict):
+                continue
+            group = buy_file_path(session_config)
+            groups[session_name] = group
+            proxy = session_config.get('proxy')
+            if proxy and proxy not in proxies.setdefault(group, []):
+                proxies[group].append(proxy)
+        self._groups, self._proxies = groups, proxies
+
+    def healthy(self, proxy: str) -> bool:
+        return self._resting_until.get(proxy, 0) <= time()
+
+    def candidates(self, session_name: str,
+                   own_proxy: Optional[str]) -> List[str]:
+        # Healthy proxies of the group other than the session's own,
+        # fastest first
+        self._refresh()
+        group = self._groups.get(session_name)
+        return sorted((proxy for proxy in self._proxies.get(group, [])
+                       if proxy != own_proxy and self.healthy(proxy)),
+                      key=lambda proxy: self._latency.get(proxy, 0.0))
+
+    def record(self, proxy: str, ok: bool,
+               latency: Optional[float] = None) -> None:
+        if ok:
+            self._failures.pop(proxy, None)
+            if latency is not None:
+                previous = self._latency.get(proxy)
+                self._latency[proxy] = (latency if previous is None else
+                                        previous + 0.2 * (latency - previous))
+            return
+        self._failures[proxy] = self._failures.get(proxy, 0) + 1
+        if self._failures[proxy] >= PROXY_FAILURES_TO_REST:
+            self._failures.pop(proxy)
+            self._resting_until[proxy] = time() + PROXY_REST_SECONDS
+
+
+class RequestHedger:
+    def __init__(self, session_name: str, groups: ProxyGroups):
+        self._session_name = session_name
+        self._groups = groups
+        # endpoint -> recent latencies of first attempts
+        self._latencies: Dict[str, deque] = {}
+        self._clients: Dict[str, CloudflareScraper] = {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # No healthy proxy of the group or no rate budget left for one
+        self.skipped = 0
+
+    def hedge_delay(self, endpoint: str) -> Optional[float]:
+        latencies = self._latencies.get(endpoint)
+        if latencies is None or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(int(len(ordered) * HEDGE_QUANTILE),
+                           len(ordered) - 1)]
+
+    def _record_latency(self, endpoint: str, latency: float) -> None:
+        self._latencies.setdefault(
+            endpoint, deque(maxlen=LATENCY_WINDOW)).append(latency)
+
+    def _client(self, proxy: str) -> CloudflareScraper:
+        client = self._clients.get(proxy)
+        if client is None or client.closed:
+            client = self._clients[proxy] = CloudflareScraper(
+                timeout=aiohttp.ClientTimeout(HEDGE_TIMEOUT_SECONDS),
+                connector=ProxyConnector.from_url(proxy))
+        return client
+
+    async def close(self) -> None:
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+
+    def _take_budget(self, endpoint: str, proxy: str,
+                     limiter: Optional[AimdRateLimiter]
+                     ) -> Optional[AimdRateLimiter]:
+        # A hedge is a real request: it needs room under the limit of the
+        # proxy it goes through and is counted against the session's own
+        hedge_limiter = get_rate_controller().limiter(endpoint, proxy)
+        if hedge_limiter.headroom() <= 0 or \
+                (limiter is not None and limiter.headroom() <= 0):
+            return None
+        hedge_limiter.take()
+        if limiter is not None:
+            limiter.take()
+        return hedge_limiter
+
+    async def run(self, send: Callable[[Optional[CloudflareScraper]],
+                                       Awaitable],
+                  endpoint: str, own_proxy: Optional[str],
+                  limiter: Optional[AimdRateLimiter] = None) -> Tuple:
+        # send(None) goes through the session's own client, send(client)
+        # through a hedge client. Returns (result, whether the hedge won)
+        self.requests += 1
+        started = time()
+        primary = asyncio.ensure_future(send(None))
+        hedge = None
+        try:
+            delay = self.hedge_delay(endpoint)
+            if delay is not None:
+                await asyncio.wait({primary}, timeout=delay)
+            if primary.done() or delay is None:
+                self._record_latency(endpoint, time() - started)
+                return await primary, False
+
+            hedge_proxy = hedge_limiter = None
+            for proxy in self._groups.candidates(self._session_name,
+                                                 own_proxy):
+                hedge_limiter = self._take_budget(endpoint, proxy, limiter)
+                if hedge_limiter is not None:
+                    hedge_proxy = proxy
+                    break
+            if hedge_proxy is None:
+                self.skipped += 1
+                result = await primary
+                self._record_latency(endpoint, time() - started)
+                return result, False
+
+            self.hedges += 1
+            hedge_started = time()
+            hedge = asyncio.ensure_future(send(self._client(hedge_proxy)))
+            while True:
+                done, _ = await asyncio.wait(
+                    {primary, hedge} if not hedge.done() else {primary},
+                    return_when=asyncio.FIRST_COMPLETED)
+                if primary in done:
+                    # The first attempt answered first, whatever the answer
+                    self._record_latency(endpoint, time() - started)
+                    return await primary, False
+                error = hedge.exception()
+                if error is None and hedge.result() is not None:
+                    self.hedge_wins += 1
+                    self._groups.record(hedge_proxy, True,
+                                        time() - hedge_started)
+                    hedge_limiter.record_success()
+                    # A lower bound: the first attempt took at least this long
+                    self._record_latency(endpoint, time() - started)
+                    return hedge.result(), True
+                # A failed hedge leaves the first attempt running
+                self._groups.record(hedge_proxy, False)
+                signal = congestion_signal(error) if error else None
+                if signal is not None:
+                    hedge_limiter.record_congestion(hedge_started, signal)
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def summary(self) -> str:
+        delays = ', '.join(f"{endpoint}: {delay:.2f} с"
+                           for endpoint in self._latencies
+                           for delay in [self.hedge_delay(endpoint)]
+                           if delay is not None) or 'нет данных'
+        return (f"запросов {self.requests}, дублей {self.hedges}, из них "
+                f"быстрее основного {self.hedge_wins}, без дубля "
+                f"{self.skipped} (порог p90: {delays})")
+
+
+_groups: Optional[ProxyGroups] = None
+
+
+def get_proxy_groups() -> Optional[ProxyGroups]:
+    global _groups
+    if not settings.HEDGED_REQUESTS:
+        return None
+    if _groups is None:
+        _groups = ProxyGroups(CONFIG_PATH)
+    return _groups
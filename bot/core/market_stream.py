@@ -0,0 +1,153 @@
+import json
+import re
+from time import time
+from typing import Dict, List, Optional
+
+
+_OUTSIDE_STRING = re.compile(rb'[{}\[\]"]')
+_INSIDE_STRING = re.compile(rb'["\\]')
+
+# Root object -> "data" object -> "items" array
+ITEMS_ARRAY_DEPTH = 3
+
+
+class MarketItemStream:
+    def __init__(self):
+        self._buffer = b''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._string_start = 0
+        self._last_string = b''
+        self._items_depth: Optional[int] = None
+        self._item_start: Optional[int] = None
+        self.done = False
+
+    @property
+    def found_items(self) -> bool:
+        return self._items_depth is not None
+
+    def feed(self, chunk: bytes) -> List[Dict]:
+        if self.done:
+            return []
+        buf = self._buffer + chunk
+        pos = self._pos
+        items = []
+
+        while True:
+            if self._in_string:
+                match = _INSIDE_STRING.search(buf, pos)
+                if not match:
+                    pos = len(buf)
+                    break
+                if match.group() == b'\\':
+                    if match.end() >= len(buf):
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                if self._item_start is None:
+                    self._last_string = buf[self._string_start:match.start()]
+                pos = match.end()
+                continue
+
+            match = _OUTSIDE_STRING.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+
+            if char == b'"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in (b'{', b'['):
+                self._depth += 1
+                if (char == b'[' and self._items_depth is None and
+                        self._depth == ITEMS_ARRAY_DEPTH and
+                        self._last_string == b'items'):
+                    self._items_depth = self._depth
+                elif (char == b'{' and self._items_depth is not None and
+                      self._depth == self._items_depth + 1):
+                    self._item_start = match.start()
+            else:
+                if (char == b'}' and self._item_start is not None and
+                        self._depth == self._items_depth + 1):
+                    items.append(json.loads(buf[self._item_start:pos]))
+                    self._item_start = None
+                elif (self._items_depth is not None and
+                      self._depth == self._items_depth):
+                    self._depth -= 1
+                    self.done = True
+                    break
+                self._depth -= 1
+
+        if self._item_start is not None:
+            keep_from = self._item_start
+        elif self._in_string:
+            keep_from = self._string_start
+        else:
+            keep_from = pos
+        keep_from = min(keep_from, pos)
+        self._buffer = buf[keep_from:]
+        self._pos = pos - keep_from
+        if self._item_start is not None:
+            self._item_start -= keep_from
+        if self._in_string:
+            self._string_start -= keep_from
+        return items
+
+
+class StreamLatencyStats:
+    def __init__(self, window: int = 100):
+        self._window = window
+        self._first_item_gains: List[float] = []
+        self._match_gains: List[float] = []
+        self._pages = 0
+
+    @property
+    def pages(self) -> int:
+        return self._pages
+
+    def record_page(self, body_complete_time: float,
+                    first_item_time: Optional[float],
+                    match_times: List[float]) -> None:
+        self._pages += 1
+        if first_item_time is not None:
+            self._first_item_gains.append(body_complete_time - first_item_time)
+            self._first_item_gains = self._first_item_gains[-self._window:]
+        for match_time in match_times:
+            self._match_gains.append(body_complete_time - match_time)
+        self._match_gains = self._match_gains[-self._window:]
+
+    @staticmethod
+    def _avg(values: List[float]) -> float:
+        return sum(values) / len(values) if values else 0.0
+
+    def summary(self) -> str:
+        return (f"страниц: {self._pages}, выигрыш первого предмета: "
+                f"{self._avg(self._first_item_gains) * 1000:.1f} мс, "
+                f"выигрыш совпадений: {self._avg(self._match_gains) * 1000:.1f} мс "
+                f"({len(self._match_gains)} шт.)")
+
+
+class StreamPageTimer:
+    def __init__(self):
+        self.started = time()
+        self.first_item_time: Optional[float] = None
+        self.body_complete_time: Optional[float] = None
+        self.match_times: List[float] = []
+
+    def item_ready(self) -> float:
+        now = time()
+        if self.first_item_time is None:
+            self.first_item_time = now
+        return now
+
+    def body_complete(self) -> float:
+        self.body_complete_time = time()
+        return self.body_complete_time
+
+    def match_dispatched(self, at: float) -> None:
+        self.match_times.append(at)
@@ -0,0 +1,117 @@
+from time import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from bot.config import settings
+from bot.core.page_size import aligned_pages
+
+
+# A session that has not polled a query for this long no longer counts as
+# one of its participants
+PARTICIPANT_TTL_SECONDS = 300
+GAP_SMOOTHING = 0.2
+
+
+class QueryPartition:
+    __slots__ = ('cursor', 'sweeps', 'sessions', 'polled_at', 'gap',
+                 'sweep_started', 'sweep_seconds')
+
+    def __init__(self, now: float):
+        # Next page of the shared sweep
+        self.cursor = 1
+        self.sweeps = 0
+        # session -> (page depth it asked for, time of its last attempt)
+        self.sessions: Dict[str, Tuple[int, float]] = {}
+        self.polled_at: Dict[int, float] = {}
+        # Smoothed time between two pages of one session: one poll slot
+        self.gap: Optional[float] = None
+        self.sweep_started = now
+        self.sweep_seconds: Optional[float] = None
+
+    def depth(self, requested: int, now: float) -> int:
+        for session_name, (_, seen) in list(self.sessions.items()):
+            if now - seen > PARTICIPANT_TTL_SECONDS:
+                del self.sessions[session_name]
+        return max([requested] + [depth for depth, _ in self.sessions.values()])
+
+    def restart(self, now: float) -> None:
+        self.cursor = 1
+        self.sweeps += 1
+        self.sweep_seconds = now - self.sweep_started
+        self.sweep_started = now
+
+
+class PageCoordinator:
+    def __init__(self):
+        self._partitions: Dict[Hashable, QueryPartition] = {}
+
+    def _partition(self, query_key: Hashable, now: float) -> QueryPartition:
+        partition = self._partitions.get(query_key)
+        if partition is None:
+            partition = self._partitions[query_key] = QueryPartition(now)
+        return partition
+
+    def sweeps(self, query_key: Hashable) -> int:
+        partition = self._partitions.get(query_key)
+        return partition.sweeps if partition else 0
+
+    def lease(self, query_key: Hashable, session_name: str, depth: int,
+              pages: int = 1) -> Optional[Tuple[int, int]]:
+        # All sessions scanning the query share one cursor, so every page is
+        # visited once per sweep and N sessions sweep N times as often.
+        # Returns the first page and how many pages the request covers
+        now = time()
+        partition = self._partition(query_key, now)
+        sweep_depth = partition.depth(depth, now)
+        if partition.cursor > sweep_depth:
+            partition.restart(now)
+        page = partition.cursor
+        # The slot is a session's poll cadence, so denied attempts count
+        # too: measured between leases only, every denial would widen the
+        # slot and cause more denials
+        previous = partition.sessions.get(session_name)
+        if previous is not None:
+            sample = now - previous[1]
+            partition.gap = (sample if partition.gap is None else
+                             partition.gap + GAP_SMOOTHING *
+                             (sample - partition.gap))
+        partition.sessions[session_name] = (depth, now)
+        polled_at = partition.polled_at.get(page)
+        if polled_at is not None and partition.gap is not None and \
+                now - polled_at < partition.gap:
+            # More sessions than pages: the page was already polled in this
+            # slot, the session waits instead of repeating it
+            return None
+
+        pages = aligned_pages(page, pages, sweep_depth)
+        for leased in range(page, page + pages):
+            partition.polled_at[leased] = now
+        partition.cursor += pages
+        return page, pages
+
+    def end_of_results(self, query_key: Hashable, page: int) -> None:
+        # An empty page or one past the price cutoff ends the sweep for
+        # every participant
+        partition = self._partitions.get(query_key)
+        if partition is not None and partition.cursor > page:
+            partition.restart(time())
+
+    def summary(self, query_key: Hashable) -> Optional[str]:
+        partition = self._partitions.get(query_key)
+        if partition is None:
+            return None
+        sweep = (f"{partition.sweep_seconds:.0f} с"
+                 if partition.sweep_seconds is not None else 'нет данных')
+        return (f"сессий {len(partition.sessions)}, обходов "
+                f"{partition.sweeps}, обход за {sweep}")
+
+
+_coordinator: Optional[PageCoordinator] = None
+
+
+def get_page_coordinator() -> Optional[PageCoordinator]:
+    global _coordinator
+    if not settings.COOPERATIVE_PAGING:
+        return None
+    if _coordinator is None:
+        _coordinator = PageCoordinator()
+    return _coordinator
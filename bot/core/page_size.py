@@ -0,0 +1,166 @@
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+LATENCY_SMOOTHING = 0.2
+# Requests a page size needs before its latency is trusted
+MIN_SAMPLES = 5
+
+
+def aligned_pages(page: int, desired: int, last_page: int) -> int:
+    # Page numbers stay in base-size pages. A request of k base pages is
+    # page (page - 1) / k + 1 of size k * base, so it has to start on a
+    # multiple of k; it also stops at the last page of the sweep
+    for pages in range(min(desired, last_page - page + 1), 1, -1):
+        if (page - 1) % pages == 0:
+            return pages
+    return 1
+
+
+def split_pages(items: List[Dict], page_size: int, pages: int) -> List[List[Dict]]:
+    # The listings of a k-page request as the k base pages they cover; a
+    # server that returns more than asked keeps the excess on the last one
+    return [items[i * page_size:(i + 1) * page_size if i < pages - 1 else None]
+            for i in range(pages)]
+
+
+class ResponseSize:
+    __slots__ = ('body_bytes', 'wire_bytes', 'encoding')
+
+    def __init__(self):
+        self.body_bytes = 0
+        # Compressed size when the server says it (Content-Length of an
+        # encoded body), otherwise the body size
+        self.wire_bytes: Optional[int] = None
+        self.encoding: Optional[str] = None
+
+    def start(self, response) -> None:
+        self.encoding = response.headers.get('Content-Encoding')
+        if self.encoding:
+            self.wire_bytes = response.content_length
+
+    def add(self, chunk: bytes) -> None:
+        self.body_bytes += len(chunk)
+
+    @property
+    def transferred(self) -> int:
+        return self.wire_bytes if self.wire_bytes is not None \
+            else self.body_bytes
+
+
+class _SizeStats:
+    __slots__ = ('requests', 'latency', 'items', 'body_bytes', 'wire_bytes')
+
+    def __init__(self):
+        self.requests = 0
+        self.latency: Optional[float] = None
+        self.items = 0
+        self.body_bytes = 0
+        self.wire_bytes = 0
+
+
+class PageSizeSelector:
+    def __init__(self, base_size: int, max_size: int, latency_target: float,
+                 adaptive: bool = True):
+        self.base_size = base_size
+        self._max_pages = max(1, max_size // base_size) if adaptive else 1
+        self._latency_target = latency_target
+        # base pages per request -> measurements
+        self._stats: Dict[int, _SizeStats] = {}
+        # query -> (first page after a short response, listings in it)
+        self._short: Dict[Hashable, Tuple[int, int]] = {}
+        self.cap: Optional[int] = None
+
+    def _fit(self) -> Optional[Tuple[float, float]]:
+        # latency ~ a + b * listings requested, over the measured sizes
+        points = [(pages * self.base_size, stats.latency, stats.requests)
+                  for pages, stats in self._stats.items()
+                  if stats.requests >= MIN_SAMPLES]
+        if len(points) < 2:
+            return None
+        weight = sum(w for _, _, w in points)
+        mean_x = sum(x * w for x, _, w in points) / weight
+        mean_y = sum(y * w for _, y, w in points) / weight
+        var = sum(w * (x - mean_x) ** 2 for x, _, w in points)
+        slope = max(0.0, sum(w * (x - mean_x) * (y - mean_y)
+                             for x, y, w in points) / var)
+        return mean_y - slope * mean_x, slope
+
+    def predicted_latency(self, pages: int) -> Optional[float]:
+        stats = self._stats.get(pages)
+        if stats is not None and stats.requests >= MIN_SAMPLES:
+            return stats.latency
+        fit = self._fit()
+        if fit is None:
+            return None
+        return fit[0] + fit[1] * pages * self.base_size
+
+    def desired_pages(self) -> int:
+        # The largest request that stays under the latency target: every
+        # request costs the same share of the rate budget, so more listings
+        # per request is cheaper. Sizes are tried one step above the
+        # largest one measured so far
+        limit = self._max_pages
+        if self.cap is not None:
+            limit = min(limit, max(1, self.cap // self.base_size))
+        measured = [pages for pages, stats in self._stats.items()
+                    if stats.requests >= MIN_SAMPLES]
+        best = 1
+        for pages in range(2, min(limit, max(measured, default=1) + 1) + 1):
+            latency = self.predicted_latency(pages)
+            if latency is None:
+                # Only the base size is known: probe the next one if the
+                # base size leaves room for it
+                latency = self.predicted_latency(pages - 1)
+                if latency is None or latency * pages / (pages - 1) > \
+                        self._latency_target:
+                    break
+            elif latency > self._latency_target:
+                break
+            best = pages
+        return best
+
+    def record(self, pages: int, latency: float, items: int,
+               response_size: Optional[ResponseSize] = None) -> None:
+        stats = self._stats.setdefault(pages, _SizeStats())
+        stats.requests += 1
+        stats.latency = (latency if stats.latency is None else
+                         stats.latency + LATENCY_SMOOTHING *
+                         (latency - stats.latency))
+        stats.items += items
+        if response_size is not None:
+            stats.body_bytes += response_size.body_bytes
+            stats.wire_bytes += response_size.transferred
+
+    def record_sequence(self, query_key: Hashable, page: int, pages: int,
+                        items: int) -> bool:
+        # A short response is normally the end of the results. If a later
+        # page of the same sweep still has listings, the server caps
+        # page_size. Returns whether a cap was found
+        found = False
+        short = self._short.pop(query_key, None)
+        if short is not None and page >= short[0] and items:
+            self.cap = short[1]
+            found = True
+        if pages > 1 and 0 < items < pages * self.base_size:
+            self._short[query_key] = (page + -(-items // self.base_size),
+                                      items)
+        return found
+
+    def summary(self) -> str:
+        parts = []
+        for pages in sorted(self._stats):
+            stats = self._stats[pages]
+            if not stats.requests:
+                continue
+            wire = (f", передано {stats.wire_bytes / stats.requests / 1024:.1f} "
+                    f"КБ" if stats.wire_bytes != stats.body_bytes else '')
+            parts.append(f"{pages * self.base_size}: запросов {stats.requests}, "
+                         f"задержка {stats.latency:.2f} с, лотов "
+                         f"{stats.items / stats.requests:.1f}/запрос, ответ "
+                         f"{stats.body_bytes / stats.requests / 1024:.1f} КБ"
+                         f"{wire}")
+        cap = f", ограничение сервера {self.cap}" if self.cap else ''
+        return (f"выбран {self.desired_pages() * self.base_size} (цель "
+                f"задержки {self._latency_target:.2f} с{cap}); "
+                + '; '.join(parts))
+
@@ -0,0 +1,119 @@
+import asyncio
+from time import time
+from typing import Dict, List, Optional
+
+from bot.core.market_stream import StreamPageTimer
+
+
+class MarketBatch:
+    __slots__ = ('filters', 'page', 'items', 'timer', 'page_done',
+                 'strategy', 'created_at')
+
+    def __init__(self, filters: List[Dict], page: int, items: List[Dict],
+                 timer: Optional[StreamPageTimer] = None,
+                 page_done: bool = True, strategy: str = 'filter'):
+        # Every filter served by the query the page was fetched with
+        self.filters = filters
+        self.strategy = strategy
+        self.page = page
+        self.items = items
+        self.timer = timer
+        self.page_done = page_done
+        self.created_at = time()
+
+
+class BuyCandidate:
+    __slots__ = ('filter_obj', 'item_name', 'market_equipment_id', 'price_tok',
+                 'score', 'created_at')
+
+    def __init__(self, filter_obj: Dict, item_name: str,
+                 market_equipment_id: str, price_tok: float,
+                 score: float = 0.0):
+        self.filter_obj = filter_obj
+        self.item_name = item_name
+        self.market_equipment_id = market_equipment_id
+        self.price_tok = price_tok
+        self.score = score
+        self.created_at = time()
+
+    def __lt__(self, other: 'BuyCandidate') -> bool:
+        # Buy queue order: best score first, then oldest first
+        return (-self.score, self.created_at) < (-other.score, other.created_at)
+
+
+class StageStats:
+    def __init__(self, name: str, queue: Optional[asyncio.Queue] = None,
+                 window: int = 100):
+        self.name = name
+        self._queue = queue
+        self._window = window
+        self._durations: List[float] = []
+        self._waits: List[float] = []
+        self.processed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.maxsize if self._queue is not None else 0
+
+    def record(self, duration: float, waited: float = 0.0) -> None:
+        self.processed += 1
+        self._durations.append(duration)
+        self._waits.append(waited)
+        if len(self._durations) > self._window:
+            del self._durations[0]
+            del self._waits[0]
+
+    @staticmethod
+    def _avg(values: List[float]) -> float:
+        return sum(values) / len(values) if values else 0.0
+
+    @property
+    def avg_latency(self) -> float:
+        return self._avg(self._durations)
+
+    @property
+    def avg_wait(self) -> float:
+        return self._avg(self._waits)
+
+    def summary(self) -> str:
+        queue_info = (f"очередь {self.queue_depth}/{self.queue_size}, "
+                      if self._queue is not None else "")
+        return (f"{self.name}: {queue_info}обработано {self.processed}, "
+                f"задержка {self.avg_latency * 1000:.0f} мс, "
+                f"ожидание {self.avg_wait * 1000:.0f} мс")
+
+
+class MarketPipeline:
+    def __init__(self, batch_queue_size: int, buy_queue_size: int):
+        self.batches: asyncio.Queue = asyncio.Queue(batch_queue_size)
+        self.buys: asyncio.PriorityQueue = asyncio.PriorityQueue(buy_queue_size)
+        # market_equipment_id -> filter of candidates queued or being bought
+        self.pending: Dict[str, Dict] = {}
+        self.fetcher = StageStats('fetcher')
+        self.evaluator = StageStats('evaluator', self.batches)
+        self.buyer = StageStats('buyer', self.buys)
+
+    def pending_for(self, filter_obj: Dict) -> int:
+        return sum(1 for f in self.pending.values() if f is filter_obj)
+
+    async def run(self, *stages) -> None:
+        tasks = [asyncio.create_task(stage) for stage in stages]
+        try:
+            done, _ = await asyncio.wait(tasks,
+                                         return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+
+    def summary(self) -> str:
+        return ' | '.join(stage.summary() for stage in
+                          (self.fetcher, self.evaluator, self.buyer))
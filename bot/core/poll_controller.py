@@ -0,0 +1,82 @@
+from math import exp
+from random import uniform
+from time import time
+from typing import Dict, Hashable, Optional, Tuple
+
+
+# New listings expected per request the controller aims for: more churn
+# means shorter delays, a quiet market means longer ones
+TARGET_ARRIVALS_PER_POLL = 0.5
+# Time constant of the arrival-rate estimate, in seconds
+ARRIVAL_TIME_CONSTANT = 300
+REVISIT_SMOOTHING = 0.2
+DELAY_JITTER = 0.2
+
+
+class PollController:
+    def __init__(self, request_limit: int, time_window: float,
+                 initial_delay: float, max_delay: float):
+        self.max_delay = max_delay
+        self.set_request_limit(request_limit, time_window)
+        # Prior: the configured delay until arrivals have been measured
+        self._rate = TARGET_ARRIVALS_PER_POLL / max(initial_delay, 1e-3)
+        self._updated_at = time()
+        self._started_at = self._updated_at
+        self._polls = 0
+        # (query, page) -> last poll; smoothed time between polls of a page
+        self._last_polled: Dict[Tuple[Hashable, int], float] = {}
+        self._revisit: Optional[float] = None
+
+    def set_request_limit(self, request_limit: float,
+                          time_window: float) -> None:
+        # Polling faster than the rate budget only makes the limiter sleep
+        self.min_delay = min(time_window / request_limit, self.max_delay)
+
+    @property
+    def arrival_rate(self) -> float:
+        # New listings per second, exponentially weighted
+        return self._rate * exp(-(time() - self._updated_at) /
+                                ARRIVAL_TIME_CONSTANT)
+
+    def record_poll(self, query_key: Hashable, page: int,
+                    arrivals: int) -> None:
+        now = time()
+        self._rate = (self._rate * exp(-(now - self._updated_at) /
+                                       ARRIVAL_TIME_CONSTANT) +
+                      arrivals / ARRIVAL_TIME_CONSTANT)
+        self._updated_at = now
+        self._polls += 1
+
+        previous = self._last_polled.get((query_key, page))
+        self._last_polled[(query_key, page)] = now
+        if previous is not None:
+            gap = now - previous
+            self._revisit = (gap if self._revisit is None else
+                             self._revisit + REVISIT_SMOOTHING *
+                             (gap - self._revisit))
+
+    def target_delay(self) -> float:
+        rate = self.arrival_rate
+        target = (TARGET_ARRIVALS_PER_POLL / rate if rate > 0
+                  else self.max_delay)
+        return min(max(target, self.min_delay), self.max_delay)
+
+    def delay(self) -> float:
+        # Jitter keeps the request pattern irregular
+        return max(self.min_delay, self.target_delay() *
+                   uniform(1 - DELAY_JITTER, 1 + DELAY_JITTER))
+
+    @property
+    def detection_latency(self) -> Optional[float]:
+        # A listing appears at a random moment between two polls of its page
+        return self._revisit / 2 if self._revisit is not None else None
+
+    def summary(self) -> str:
+        elapsed = max(time() - self._started_at, 1e-3)
+        latency = self.detection_latency
+        latency_str = (f"~{latency:.0f} с" if latency is not None
+                       else 'нет данных')
+        return (f"{self._polls * 60 / elapsed:.1f} запр./мин, задержка "
+                f"~{self.target_delay():.1f} с, новых лотов "
+                f"{self.arrival_rate * 60:.2f}/мин, ожидаемое время "
+                f"обнаружения {latency_str}")
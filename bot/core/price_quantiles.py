@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from math import ceil
+from random import random
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bot.config import settings
+from bot.utils import DATA_PATH, logger
+from bot.utils.observation_store import listing_fields
+
+
+BUCKET_SECONDS = 3600
+MAX_WINDOW_HOURS = 48
+SEEN_CACHE_SIZE = 50_000
+SAVE_INTERVAL_SECONDS = 300
+LIMIT_CACHE_SECONDS = 60
+DEFAULT_MIN_SAMPLES = 20
+# Псевдо-характеристика: все лоты типа/редкости независимо от статов
+ANY_STAT = '*'
+
+
+class KllSketch:
+    def __init__(self, k: int = 64, compactors: Optional[List[List[float]]] = None):
+        self.k = k
+        self.compactors: List[List[float]] = compactors or [[]]
+        self._size = sum(len(c) for c in self.compactors)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.compactors) - level - 1
+        return int(ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    @property
+    def count(self) -> int:
+        return sum(len(c) << h for h, c in enumerate(self.compactors))
+
+    def update(self, value: float) -> None:
+        self.compactors[0].append(value)
+        self._size += 1
+        if self._size >= self._max_size():
+            self._compress()
+
+    def _compress(self) -> None:
+        while self._size >= self._max_size():
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) < self._capacity(level):
+                    continue
+                if level + 1 == len(self.compactors):
+                    self.compactors.append([])
+                compactor.sort()
+                keep_last = compactor.pop() if len(compactor) % 2 else None
+                self.compactors[level + 1].extend(
+                    compactor[1 if random() < 0.5 else 0::2])
+                self.compactors[level] = [keep_last] if keep_last is not None else []
+                self._size = sum(len(c) for c in self.compactors)
+                break
+
+    def merge(self, other: 'KllSketch') -> None:
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self._size = sum(len(c) for c in self.compactors)
+        self._compress()
+
+    def quantile(self, q: float) -> Optional[float]:
+        weighted = sorted((value, 1 << level)
+                          for level, compactor in enumerate(self.compactors)
+                          for value in compactor)
+        if not weighted:
+            return None
+        target = q * sum(weight for _, weight in weighted)
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self) -> Dict:
+        return {'k': self.k, 'c': self.compactors}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'KllSketch':
+        return cls(data.get('k', 64), data.get('c'))
+
+
+SketchKey = Tuple[str, str, str, int]
+
+
+class PriceQuantileEngine:
+    def __init__(self, path: str):
+        self._path = path
+        # (type, rarity, stat type, stat level) -> hour bucket -> sketch
+        self._sketches: Dict[SketchKey, Dict[int, KllSketch]] = {}
+        self._seen: 'OrderedDict[str, float]' = OrderedDict()
+        self._limit_cache: Dict[str, Tuple[float, Optional[float], int]] = {}
+        self._saver: Optional[asyncio.Task] = None
+        self._dirty = False
+        self.load()
+
+    @staticmethod
+    def _bucket(now: float) -> int:
+        return int(now // BUCKET_SECONDS)
+
+    def observe(self, items: Iterable[Dict]) -> None:
+        bucket = self._bucket(time())
+        for item in items:
+            market_equipment_id = str(item.get('id'))
+            price_tok = float(item.get('price_gross', 0)) / 1_000_000_000
+            # Long-lived listings are seen on every poll; count each listing
+            # (and each reprice) once
+            if self._seen.get(market_equipment_id) == price_tok:
+                self._seen.move_to_end(market_equipment_id)
+                continue
+            self._seen[market_equipment_id] = price_tok
+            self._seen.move_to_end(market_equipment_id)
+            if len(self._seen) > SEEN_CACHE_SIZE:
+                self._seen.popitem(last=False)
+
+            equipment_type, rarity, _, stats = listing_fields(item)
+            keys = {(equipment_type, rarity, ANY_STAT, 0)}
+            keys.update((equipment_type, rarity, stat.get('type'),
+                         int(stat.get('level', 0))) for stat in stats)
+            for key in keys:
+                buckets = self._sketches.setdefault(key, {})
+                sketch = buckets.get(bucket)
+                if sketch is None:
+                    sketch = buckets[bucket] = KllSketch()
+                    self._expire(buckets, bucket)
+                sketch.update(price_tok)
+            self._dirty = True
+
+        if self._saver is None or self._saver.done():
+            self._saver = asyncio.create_task(self._run_saver())
+
+    @staticmethod
+    def _expire(buckets: Dict[int, KllSketch], current: int) -> None:
+        for bucket in [b for b in buckets if b <= current - MAX_WINDOW_HOURS]:
+            del buckets[bucket]
+
+    def quantile(self, equipment_type: str, rarity: Optional[str],
+                 stat_type: str, min_level: int, q: float,
+                 window_hours: float) -> Tuple[Optional[float], int]:
+        oldest = self._bucket(time() - window_hours * 3600)
+        merged = KllSketch()
+        for (key_type, key_rarity, key_stat, key_level), buckets in \
+                self._sketches.items():
+            if key_stat != stat_type or key_level < min_level:
+                continue
+            if equipment_type not in ('*', None) and key_type != equipment_type:
+                continue
+            if rarity and key_rarity != rarity:
+                continue
+            for bucket, sketch in buckets.items():
+                if bucket >= oldest:
+                    merged.merge(sketch)
+        return merged.quantile(q), merged.count
+
+    def estimate_for(self, filter_obj: Dict, spec: Dict) -> Optional[float]:
+        # Quantile of prices of listings like the ones the filter looks for;
+        # None until min_samples listings have been seen
+        cache_key = json.dumps([filter_obj.get('equipment_type'),
+                                filter_obj.get('rarity'),
+                                filter_obj.get('required_stats'), spec],
+                               sort_keys=True)
+        min_samples = int(spec.get('min_samples', DEFAULT_MIN_SAMPLES))
+        cached = self._limit_cache.get(cache_key)
+        now = time()
+        if cached and now - cached[0] < LIMIT_CACHE_SECONDS:
+            limit, samples = cached[1], cached[2]
+        else:
+            required_stats = filter_obj.get('required_stats') or []
+            stat_type, min_level = ANY_STAT, 0
+            if required_stats:
+                stat_type = required_stats[0].get('type')
+                min_level = int(required_stats[0].get('min_level', 0))
+            limit, samples = self.quantile(
+                filter_obj.get('equipment_type', '*'), filter_obj.get('rarity'),
+                stat_type, min_level, float(spec.get('q', 0.1)),
+                float(spec.get('hours', 24)))
+            # While warming up the merge is cheap; recompute until it is usable
+            if samples >= min_samples:
+                self._limit_cache[cache_key] = (now, limit, samples)
+        return limit if samples >= min_samples else None
+
+    def max_price_for(self, filter_obj: Dict) -> Optional[float]:
+        spec = filter_obj.get('max_price_quantile')
+        if spec is None:
+            return filter_obj.get('max_price_tok', 1e12)
+        if not isinstance(spec, dict):
+            spec = {'q': spec}
+        limit = self.estimate_for(filter_obj, spec)
+        hard_limit = filter_obj.get('max_price_tok')
+        if limit is None:
+            # Not enough data yet: only the explicit cap (if any) applies
+            return hard_limit
+        return min(limit, hard_limit) if hard_limit is not None else limit
+
+    async def _run_saver(self) -> None:
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL_SECONDS)
+            if self._dirty:
+                self._dirty = False
+                try:
+                    await asyncio.to_thread(self.save, self._snapshot())
+                except OSError as e:
+                    logger.warning(f"Не удалось сохранить квантили цен: {e}")
+
+    def _snapshot(self) -> List:
+        return [[list(key), {str(b): s.to_dict() for b, s in buckets.items()}]
+                for key, buckets in self._sketches.items()]
+
+    def save(self, snapshot: Optional[List] = None) -> None:
+        snapshot = snapshot if snapshot is not None else self._snapshot()
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self._path)
+
+    def load(self) -> None:
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        current = self._bucket(time())
+        for key, buckets in snapshot:
+            restored = {int(b): KllSketch.from_dict(s)
+                        for b, s in buckets.items()}
+            self._expire(restored, current)
+            if restored:
+                self._sketches[tuple(key)] = restored
+
+
+_engine: Optional[PriceQuantileEngine] = None
+
+
+def get_price_quantiles() -> Optional[PriceQuantileEngine]:
+    global _engine
+    if not settings.PRICE_QUANTILES:
+        return None
+    if _engine is None:
+        _engine = PriceQuantileEngine(os.path.join(DATA_PATH,
+                                                   'price_sketches.json'))
+    return _engine
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from math import ceil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bot.config import settings
+from bot.utils.observation_store import listing_fields
+
+
+SEEN_CACHE_SIZE = 50_000
+# Counts are halved past this many listings per (type, rarity) so the
+# statistics follow the current market
+DECAY_THRESHOLD = 5_000
+MIN_OBSERVED_LISTINGS = 50
+# While some required stat has no estimate, every n-th plan queries by it
+EXPLORE_EVERY = 5
+
+
+class QueryPlan:
+    __slots__ = ('statistic', 'sort_by_statistic', 'selectivity',
+                 'expected_pages')
+
+    def __init__(self, statistic: Optional[str], sort_by_statistic: Optional[str],
+                 selectivity: Optional[float], expected_pages: Optional[int]):
+        self.statistic = statistic
+        self.sort_by_statistic = sort_by_statistic
+        self.selectivity = selectivity
+        self.expected_pages = expected_pages
+
+    def __str__(self) -> str:
+        if self.selectivity is None:
+            return f"статистика {self.statistic or '-'}, нет данных"
+        return (f"статистика {self.statistic or '-'}, селективность "
+                f"{self.selectivity:.1%}, ожидается ~{self.expected_pages} стр.")
+
+
+class QueryPlanner:
+    def __init__(self):
+        self._seen: 'OrderedDict[str, None]' = OrderedDict()
+        # (type, rarity) -> distinct listings observed
+        self._totals: Dict[Tuple[str, str], float] = {}
+        # (type, rarity, stat) -> listings fetched with statistic=stat; these
+        # are preselected by the server and say nothing about how rare it is
+        self._biased: Dict[Tuple[str, str, str], float] = {}
+        # (type, rarity, stat) -> level -> listings carrying it
+        self._levels: Dict[Tuple[str, str, str], Dict[int, float]] = {}
+        # (type, rarity, stat) -> level -> listings returned for statistic=stat
+        self._query_levels: Dict[Tuple[str, str, str], Dict[int, float]] = {}
+        # (filter type, filter rarity, stat) -> pages of results the server
+        # returned for statistic=stat (a lower bound until a partial page)
+        self._depths: Dict[Tuple[str, str, str], int] = {}
+        self._plans = 0
+
+    def observe(self, items: Iterable[Dict],
+                query_statistic: Optional[str] = None) -> None:
+        for item in items:
+            market_equipment_id = str(item.get('id'))
+            if market_equipment_id in self._seen:
+                continue
+            self._seen[market_equipment_id] = None
+            if len(self._seen) > SEEN_CACHE_SIZE:
+                self._seen.popitem(last=False)
+
+            equipment_type, rarity, _, stats = listing_fields(item)
+            group = (equipment_type, rarity)
+            self._totals[group] = self._totals.get(group, 0) + 1
+            if query_statistic:
+                key = (equipment_type, rarity, query_statistic)
+                self._biased[key] = self._biased.get(key, 0) + 1
+            best_levels: Dict[str, int] = {}
+            for stat in stats:
+                stat_type = stat.get('type')
+                best_levels[stat_type] = max(best_levels.get(stat_type, 0),
+                                             int(stat.get('level', 0)))
+            for stat_type, level in best_levels.items():
+                counts = (self._query_levels if stat_type == query_statistic
+                          else self._levels)
+                levels = counts.setdefault((equipment_type, rarity, stat_type),
+                                           {})
+                levels[level] = levels.get(level, 0) + 1
+            if self._totals[group] > DECAY_THRESHOLD:
+                self._decay(group)
+
+    def _decay(self, group: Tuple[str, str]) -> None:
+        self._totals[group] /= 2
+        for key in self._biased:
+            if key[:2] == group:
+                self._biased[key] /= 2
+        for counts in (self._levels, self._query_levels):
+            for key, levels in counts.items():
+                if key[:2] == group:
+                    for level in levels:
+                        levels[level] /= 2
+
+    def record_page(self, filter_obj: Dict, statistic: Optional[str],
+                    page: int, item_count: int, page_size: int) -> None:
+        if not statistic:
+            return
+        key = (filter_obj.get('equipment_type', '*'), filter_obj.get('rarity'),
+               statistic)
+        if item_count >= page_size:
+            self._depths[key] = max(self._depths.get(key, 0), page)
+        else:
+            # A partial page is the end of the result list
+            end = page if item_count else page - 1
+            self._depths[key] = min(self._depths.get(key, end), end)
+
+    def _groups(self, filter_obj: Dict) -> List[Tuple[str, str]]:
+        equipment_type = filter_obj.get('equipment_type', '*')
+        rarity = filter_obj.get('rarity')
+        return [group for group in self._totals
+                if (equipment_type == '*' or group[0] == equipment_type) and
+                (not rarity or group[1] == rarity)]
+
+    def _estimate(self, groups: List[Tuple[str, str]], stat_type: str,
+                  min_level: int) -> Tuple[Optional[float], float]:
+        # Returns (share of listings carrying the stat at min_level or higher,
+        # number of distinct listings observed for the filter's groups)
+        total = sum(self._totals[group] for group in groups)
+        unbiased = total - sum(self._biased.get((*group, stat_type), 0)
+                               for group in groups)
+        if unbiased < MIN_OBSERVED_LISTINGS:
+            return None, total
+        matching = sum(count for group in groups
+                       for level, count in self._levels.get(
+                           (*group, stat_type), {}).items()
+                       if level >= min_level)
+        return matching / unbiased, total
+
+    def _share_at_level(self, groups: List[Tuple[str, str]], stat_type: str,
+                        min_level: int) -> float:
+        counts = [(level, count) for group in groups
+                  for level, count in self._query_levels.get(
+                      (*group, stat_type), {}).items()]
+        total = sum(count for _, count in counts)
+        if not total:
+            return 1.0
+        return sum(count for level, count in counts if level >= min_level) / total
+
+    def _expected_pages(self, filter_obj: Dict, groups: List[Tuple[str, str]],
+                        stat_filter: Dict, page_size: int
+                        ) -> Tuple[Optional[int], Optional[float]]:
+        stat_type = stat_filter.get('type')
+        min_level = int(stat_filter.get('min_level', 0))
+        selectivity, total = self._estimate(groups, stat_type, min_level)
+        depth = self._depths.get((filter_obj.get('equipment_type', '*'),
+                                  filter_obj.get('rarity'), stat_type))
+        if depth is not None:
+            # sort_by_statistic=desc puts listings at min_level or higher first
+            share = self._share_at_level(groups, stat_type, min_level)
+            return max(1, ceil(depth * share)), selectivity
+        if selectivity is not None:
+            return max(1, ceil(total * selectivity / page_size)), selectivity
+        return None, None
+
+    def plan(self, filter_obj: Dict, page_size: int) -> QueryPlan:
+        required_stats = filter_obj.get('required_stats') or []
+        if not required_stats:
+            return QueryPlan(None, None, None, None)
+
+        self._plans += 1
+        groups = self._groups(filter_obj)
+        best: Optional[Tuple[int, str, Optional[float]]] = None
+        unknown = []
+        for stat_filter in required_stats:
+            pages, selectivity = self._expected_pages(filter_obj, groups,
+                                                      stat_filter, page_size)
+            if pages is None:
+                unknown.append(stat_filter.get('type'))
+            elif best is None or pages < best[0]:
+                best = (pages, stat_filter.get('type'), selectivity)
+
+        if unknown and self._plans % EXPLORE_EVERY == 0:
+            statistic = unknown[(self._plans // EXPLORE_EVERY) % len(unknown)]
+            return QueryPlan(statistic, 'desc', None, None)
+        if best is None:
+            # Not enough data: keep the order the user wrote
+            return QueryPlan(required_stats[0]['type'], 'desc', None, None)
+
+        expected_pages, statistic, selectivity = best
+        return QueryPlan(statistic, 'desc', selectivity, expected_pages)
+
+
+_planner: Optional[QueryPlanner] = None
+
+
+def get_query_planner() -> Optional[QueryPlanner]:
+    global _planner
+    if not settings.QUERY_PLANNER:
+        return None
+    if _planner is None:
+        _planner = QueryPlanner()
+    return _planner
@@ -0,0 +1,155 @@
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from bot.config import settings
+
+
+class SessionCapacity:
+    __slots__ = ('balance', 'rate_headroom', 'updated_at')
+
+    def __init__(self, balance: Optional[float], rate_headroom: int):
+        self.balance = balance
+        self.rate_headroom = rate_headroom
+        self.updated_at = time()
+
+    def can_work_on(self, max_price: float) -> bool:
+        if self.rate_headroom <= 0:
+            return False
+        return self.balance is None or self.balance >= max_price
+
+
+class GlobalQuota:
+    def __init__(self, key: str, quantity: int, max_price: float):
+        self.key = key
+        self.quantity = quantity
+        self.max_price = max_price
+        self.bought_by_session: Dict[str, int] = {}
+        # session -> last heartbeat of the quota unit leased to it
+        self.leases: Dict[str, float] = {}
+
+    @property
+    def bought(self) -> int:
+        return sum(self.bought_by_session.values())
+
+    @property
+    def complete(self) -> bool:
+        return self.bought >= self.quantity
+
+    @property
+    def open_units(self) -> int:
+        return max(self.quantity - self.bought - len(self.leases), 0)
+
+
+class QuotaCoordinator:
+    def __init__(self, lease_ttl: float):
+        self._lease_ttl = lease_ttl
+        self._quotas: Dict[str, GlobalQuota] = {}
+        self._capacity: Dict[str, SessionCapacity] = {}
+
+    def register(self, filter_obj: Dict, key: str) -> None:
+        quota = self._quotas.get(key)
+        if quota is None:
+            self._quotas[key] = GlobalQuota(
+                key, int(filter_obj.get('quantity', 1)),
+                float(filter_obj.get('max_price_tok', 0)))
+        else:
+            # Tuning fields are not part of the key and may change on .buy
+            # reload
+            quota.quantity = int(filter_obj.get('quantity', 1))
+            quota.max_price = float(filter_obj.get('max_price_tok', 0))
+
+    def report_capacity(self, session_name: str, balance: Optional[float],
+                        rate_headroom: int) -> None:
+        self._capacity[session_name] = SessionCapacity(balance, rate_headroom)
+
+    def _capacity_of(self, session_name: str) -> SessionCapacity:
+        return self._capacity.get(session_name) or SessionCapacity(None, 1)
+
+    def is_complete(self, key: str) -> bool:
+        return self._quotas[key].complete
+
+    def all_complete(self, keys: List[str]) -> bool:
+        return all(self._quotas[key].complete for key in keys)
+
+    def bought(self, key: str) -> int:
+        return self._quotas[key].bought
+
+    def quantity(self, key: str) -> int:
+        return self._quotas[key].quantity
+
+    def holds(self, session_name: str, key: str) -> bool:
+        quota = self._quotas[key]
+        return not quota.complete and session_name in quota.leases
+
+    def heartbeat(self, session_name: str, key: str) -> None:
+        quota = self._quotas[key]
+        if session_name in quota.leases:
+            quota.leases[session_name] = time()
+
+    def _is_busy(self, session_name: str, last_seen: float,
+                 quota: GlobalQuota, now: float) -> bool:
+        if now - last_seen > self._lease_ttl:
+            return True
+        return not self._capacity_of(session_name).can_work_on(quota.max_price)
+
+    def claim_work(self, session_name: str, keys: List[str]) -> Optional[str]:
+        now = time()
+        for key in keys:
+            if self.holds(session_name, key):
+                return key
+
+        capacity = self._capacity_of(session_name)
+        candidates = [self._quotas[key] for key in keys
+                      if not self._quotas[key].complete and
+                      capacity.can_work_on(self._quotas[key].max_price)]
+
+        open_quotas = [quota for quota in candidates if quota.open_units > 0]
+        if open_quotas:
+            quota = max(open_quotas, key=lambda q: q.open_units)
+            quota.leases[session_name] = now
+            return quota.key
+
+        # Work stealing: take over units held by sessions that went silent or
+        # ran out of balance / rate budget
+        steal_from: Optional[Tuple[GlobalQuota, str]] = None
+        for quota in candidates:
+            for owner, last_seen in quota.leases.items():
+                if owner != session_name and \
+                        self._is_busy(owner, last_seen, quota, now):
+                    steal_from = (quota, owner)
+                    break
+            if steal_from:
+                break
+        if steal_from:
+            quota, owner = steal_from
+            del quota.leases[owner]
+            quota.leases[session_name] = now
+            return quota.key
+        return None
+
+    def seed(self, session_name: str, key: str, bought: int) -> None:
+        # Progress restored from the session's purchase ledger
+        quota = self._quotas[key]
+        quota.bought_by_session[session_name] = max(
+            quota.bought_by_session.get(session_name, 0), bought)
+
+    def commit(self, session_name: str, key: str) -> None:
+        quota = self._quotas[key]
+        quota.bought_by_session[session_name] = \
+            quota.bought_by_session.get(session_name, 0) + 1
+        quota.leases.pop(session_name, None)
+
+    def release(self, session_name: str, key: str) -> None:
+        self._quotas[key].leases.pop(session_name, None)
+
+
+_coordinator: Optional[QuotaCoordinator] = None
+
+
+def get_quota_coordinator() -> Optional[QuotaCoordinator]:
+    global _coordinator
+    if not settings.GLOBAL_FILTER_QUOTAS:
+        return None
+    if _coordinator is None:
+        _coordinator = QuotaCoordinator(settings.QUOTA_LEASE_TTL)
+    return _coordinator
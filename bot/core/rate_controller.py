@@ -0,0 +1,180 @@
+import asyncio
+from time import time
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+import aiohttp
+
+from bot.config import settings
+
+
+TIME_WINDOW_SECONDS = 60
+MIN_REQUEST_LIMIT = 5
+MAX_REQUEST_LIMIT = 120
+# The limit grows by one request per window of successes, and only while
+# it is what holds the requests back
+PROBE_STEP = 1
+PROBE_UTILISATION = 0.8
+# After a cut the limit climbs back fast to this share of the limit that
+# was cut, then probes one step at a time
+RECOVERY_SHARE = 0.9
+# 429 is an explicit limit; 400 and timeouts are also sent by a throttling
+# server but can have other causes, so they cut less
+BACKOFF_FACTORS = {429: 0.5, 400: 0.7, 'timeout': 0.8}
+CONGESTION_STATUSES = (400, 429)
+
+
+def congestion_signal(error: BaseException):
+    # 429, 400 or 'timeout' when the error says the server is throttling
+    if isinstance(error, aiohttp.ClientResponseError) and \
+            error.status in CONGESTION_STATUSES:
+        return error.status
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    return None
+
+
+class AimdRateLimiter:
+    def __init__(self, initial_limit: float, time_window: float,
+                 min_limit: float, max_limit: float):
+        # Bounds are per session and scale with the sessions sharing the
+        # limiter
+        self.limit = float(initial_limit)
+        self.time_window = time_window
+        self._initial_limit = initial_limit
+        self._min_share = min_limit
+        self._max_share = max(max_limit, min_limit)
+        self._sessions: Set[str] = set()
+        self._request_times: List[float] = []
+        self._credit = 0.0
+        # Requests sent before the last cut report the old congestion,
+        # they do not cut again
+        self._cut_at = 0.0
+        self._ceiling: Optional[float] = None
+        self.cuts: Dict = {}
+        self.successes = 0
+
+    @property
+    def shares(self) -> int:
+        return max(len(self._sessions), 1)
+
+    @property
+    def _min_limit(self) -> float:
+        return self._min_share * self.shares
+
+    @property
+    def _max_limit(self) -> float:
+        return self._max_share * self.shares
+
+    @property
+    def session_limit(self) -> float:
+        return self.limit / self.shares
+
+    def join(self, session_name: str) -> None:
+        # Another session sends through this limiter: the budget grows by
+        # one session's initial share
+        if session_name in self._sessions:
+            return
+        self._sessions.add(session_name)
+        if len(self._sessions) > 1:
+            self.limit = min(self.limit + self._initial_limit,
+                             self._max_limit)
+
+    def _recent(self, now: float) -> int:
+        self._request_times = [t for t in self._request_times
+                               if now - t < self.time_window]
+        return len(self._request_times)
+
+    async def wait_for_next_request(self, log_method=None) -> None:
+        # Sessions behind the same proxy share the limiter, so the window is
+        # checked again after every sleep
+        while self._recent(time()) >= int(self.limit):
+            sleep_time = (self.time_window - (time() - self._request_times[0])
+                          + 0.5)
+            if log_method is not None:
+                log_method('debug', f"Достигнут лимит запросов "
+                                    f"({int(self.limit)}/{self.time_window}s). "
+                                    f"Сон на {sleep_time:.2f}s",
+                           emoji_key='sleep')
+            await asyncio.sleep(sleep_time)
+        self._request_times.append(time())
+
+    def take(self) -> None:
+        # Counts a request sent without waiting for the window
+        self._request_times.append(time())
+
+    def headroom(self) -> int:
+        return int(self.limit) - self._recent(time())
+
+    @property
+    def at_floor(self) -> bool:
+        return self.limit <= self._min_limit
+
+    def record_success(self) -> None:
+        self.successes += 1
+        if self._recent(time()) < PROBE_UTILISATION * int(self.limit):
+            return
+        self._credit += 1 / self.limit
+        if self._credit >= 1:
+            self._credit = 0.0
+            step = PROBE_STEP
+            if self._ceiling is not None:
+                step = max(step, (RECOVERY_SHARE * self._ceiling -
+                                  self.limit) / 2)
+            self.limit = min(self.limit + step, self._max_limit)
+
+    def record_congestion(self, started: float, signal) -> bool:
+        # Returns whether the limit was cut
+        if started < self._cut_at:
+            return False
+        self._ceiling = self.limit
+        self.limit = max(self.limit * BACKOFF_FACTORS[signal], self._min_limit)
+        self._credit = 0.0
+        self._cut_at = time()
+        self.cuts[signal] = self.cuts.get(signal, 0) + 1
+        return True
+
+    def summary(self) -> str:
+        cuts = ', '.join(f"{signal}: {count}"
+                         for signal, count in self.cuts.items()) or 'нет'
+        return (f"{int(self.limit)}/{self.time_window} с, успешных "
+                f"{self.successes}, снижений ({cuts})")
+
+
+class RateController:
+    def __init__(self, initial_limit: float, adaptive: bool = True):
+        self._initial_limit = initial_limit
+        self._adaptive = adaptive
+        self._limiters: Dict[Tuple[Hashable, ...], AimdRateLimiter] = {}
+
+    def limiter(self, endpoint: str, proxy: Optional[str],
+                session_name: Optional[str] = None) -> AimdRateLimiter:
+        # The server limit may differ per endpoint and per client IP, so the
+        # learned limit is shared by the sessions behind one proxy (or
+        # behind none) and its bounds grow with their number. The fixed
+        # limit stays a per-session budget
+        if self._adaptive:
+            key = (endpoint, proxy)
+        else:
+            key = (endpoint, proxy, session_name)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            if self._adaptive:
+                bounds = (MIN_REQUEST_LIMIT, MAX_REQUEST_LIMIT)
+            else:
+                bounds = (self._initial_limit, self._initial_limit)
+            limiter = self._limiters[key] = AimdRateLimiter(
+                self._initial_limit, TIME_WINDOW_SECONDS, *bounds)
+        if session_name is not None:
+            limiter.join(session_name)
+        return limiter
+
+
+_controller: Optional[RateController] = None
+
+
+def get_rate_controller() -> RateController:
+    global _controller
+    if _controller is None:
+        _controller = RateController(settings.MARKET_RATE_LIMIT,
+                                     settings.ADAPTIVE_RATE_LIMIT)
+    return _controller
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+FILTER = 'filter'
+SUPERSET = 'superset'
+STRATEGIES = (FILTER, SUPERSET)
+
+# Counters are halved past this many requests so costs follow the market
+COST_WINDOW_REQUESTS = 400
+MIN_REQUESTS = 20
+EXPLORE_EVERY = 10
+SEEN_MATCHES_SIZE = 20_000
+
+
+class ScanCost:
+    __slots__ = ('requests', 'listings', 'matches')
+
+    def __init__(self):
+        self.requests = 0.0
+        self.listings = 0.0
+        self.matches = 0.0
+
+    @property
+    def requests_per_match(self) -> float:
+        # Smoothed so a strategy that has found nothing yet still gets a cost
+        return self.requests / (self.matches + 1)
+
+    @property
+    def listings_per_page(self) -> float:
+        return self.listings / self.requests if self.requests else 0.0
+
+    @property
+    def match_rate(self) -> float:
+        return self.matches / self.listings if self.listings else 0.0
+
+    def decay(self) -> None:
+        self.requests /= 2
+        self.listings /= 2
+        self.matches /= 2
+
+
+class ScanStrategy:
+    def __init__(self, mode: str):
+        self._mode = mode if mode in STRATEGIES else 'auto'
+        self._costs: Dict[str, ScanCost] = {name: ScanCost()
+                                            for name in STRATEGIES}
+        self._seen_matches: 'OrderedDict[Tuple[str, str], None]' = \
+            OrderedDict()
+        self._decisions = 0
+
+    def choose(self) -> str:
+        if self._mode != 'auto':
+            return self._mode
+        self._decisions += 1
+        for name in STRATEGIES:
+            if self._costs[name].requests < MIN_REQUESTS:
+                return name
+        best, other = sorted(STRATEGIES,
+                             key=lambda name: self._costs[name].requests_per_match)
+        return other if self._decisions % EXPLORE_EVERY == 0 else best
+
+    def record_request(self, strategy: str, listings: int) -> None:
+        cost = self._costs[strategy]
+        cost.requests += 1
+        cost.listings += listings
+        if cost.requests > COST_WINDOW_REQUESTS:
+            cost.decay()
+
+    def record_match(self, strategy: str, market_equipment_id: str) -> None:
+        # A listing stays on the market for many polls; count it once per
+        # strategy, so each one is credited with every listing it finds
+        key = (strategy, market_equipment_id)
+        if key in self._seen_matches:
+            return
+        self._seen_matches[key] = None
+        if len(self._seen_matches) > SEEN_MATCHES_SIZE:
+            self._seen_matches.popitem(last=False)
+        self._costs[strategy].matches += 1
+
+    def cost(self, strategy: str) -> Optional[float]:
+        cost = self._costs[strategy]
+        return cost.requests_per_match if cost.requests else None
+
+    def summary(self) -> str:
+        parts = []
+        for name in STRATEGIES:
+            cost = self._costs[name]
+            if not cost.requests:
+                continue
+            parts.append(f"{name}: {cost.requests_per_match:.1f} запр./совпадение, "
+                         f"{cost.listings_per_page:.1f} лотов/стр., "
+                         f"совпадений {cost.match_rate:.2%}")
+        return ' | '.join(parts) or 'нет данных'
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+# Prior for the detection rate: a new filter counts as one detection in
+# this many requests, so it gets a fair share before there is any data
+PRIOR_REQUESTS = 20
+SEEN_DETECTIONS_SIZE = 10_000
+
+
+class FilterMetrics:
+    __slots__ = ('requests', 'detections')
+
+    def __init__(self):
+        self.requests = 0
+        self.detections = 0
+
+    @property
+    def detection_rate(self) -> float:
+        return (self.detections + 1) / (self.requests + PRIOR_REQUESTS)
+
+
+class FilterScheduler:
+    def __init__(self):
+        # Stride scheduling: every scan advances a filter's pass by 1/weight,
+        # the filter with the lowest pass is scanned next
+        self._passes: Dict[str, float] = {}
+        self._metrics: Dict[str, FilterMetrics] = {}
+        self._seen: 'OrderedDict[tuple, None]' = OrderedDict()
+
+    def metrics(self, key: str) -> FilterMetrics:
+        return self._metrics.setdefault(key, FilterMetrics())
+
+    def weight(self, key: str, filter_obj: Dict) -> float:
+        priority = max(float(filter_obj.get('priority', 1)), 0.01)
+        return priority * self.metrics(key).detection_rate
+
+    def next(self, open_filters: List[Dict],
+             key_of: Callable[[Dict], str]) -> Dict:
+        keys = [key_of(f) for f in open_filters]
+        known = [self._passes[key] for key in keys if key in self._passes]
+        start = min(known) if known else 0.0
+        for key in keys:
+            # Newly opened filters join at the current front, not at zero
+            self._passes.setdefault(key, start)
+        return min(zip(open_filters, keys),
+                   key=lambda pair: self._passes[pair[1]])[0]
+
+    def record_scan(self, scanned: List[Dict],
+                    key_of: Callable[[Dict], str]) -> None:
+        # Every filter served by the query pays for it, so filters sharing a
+        # query are not scanned again on their own
+        for filter_obj in scanned:
+            self.metrics(key_of(filter_obj)).requests += 1
+        self.defer(scanned, key_of)
+
+    def defer(self, group: List[Dict], key_of: Callable[[Dict], str]) -> None:
+        # Also used without a request, when the query had nothing to poll
+        # right now: other filters go first
+        for filter_obj in group:
+            key = key_of(filter_obj)
+            self._passes[key] = (self._passes.get(key, 0.0) +
+                                 1 / self.weight(key, filter_obj))
+
+    def record_detection(self, key: str, market_equipment_id: str) -> None:
+        if (key, market_equipment_id) in self._seen:
+            return
+        self._seen[(key, market_equipment_id)] = None
+        if len(self._seen) > SEEN_DETECTIONS_SIZE:
+            self._seen.popitem(last=False)
+        self.metrics(key).detections += 1
+
+    def report(self, key: str) -> str:
+        metrics = self.metrics(key)
+        per_hundred = (metrics.detections * 100 / metrics.requests
+                       if metrics.requests else 0.0)
+        return (f"запросов {metrics.requests}, найдено {metrics.detections} "
+                f"({per_hundred:.1f} на 100 запр.)")
@@ -0,0 +1,37 @@
+from typing import Dict, Optional
+
+from bot.core.price_quantiles import PriceQuantileEngine
+
+
+# Value of a candidate: discount against a reference price plus stat levels
+# above the filter's minimums. Overridable per filter with the .buy field
+# "score"
+DEFAULT_SCORE = {
+    'price_weight': 1.0,
+    'stat_weight': 0.1,
+    # 'quantile' - median market price of similar listings, 'max_price' -
+    # the filter's price limit
+    'reference': 'quantile',
+}
+
+
+class CandidateScorer:
+    def __init__(self, quantiles: Optional[PriceQuantileEngine] = None):
+        self._quantiles = quantiles
+
+    def reference_price(self, filter_obj: Dict, spec: Dict,
+                        max_price: Optional[float]) -> Optional[float]:
+        if spec['reference'] == 'quantile' and self._quantiles is not None:
+            median = self._quantiles.estimate_for(
+                filter_obj, {'q': 0.5, 'hours': spec.get('hours', 24)})
+            if median:
+                return median
+        return max_price
+
+    def score(self, filter_obj: Dict, price_tok: float, stat_surplus: float,
+              max_price: Optional[float]) -> float:
+        spec = {**DEFAULT_SCORE, **(filter_obj.get('score') or {})}
+        reference = self.reference_price(filter_obj, spec, max_price)
+        discount = (reference - price_tok) / reference if reference else 0.0
+        return (float(spec['price_weight']) * discount +
+                float(spec['stat_weight']) * stat_surplus)
@@ -1,7 +1,8 @@
 import aiohttp
 import asyncio
 from typing import Dict, Optional, Any, Tuple, List
-from urllib.parse import urlencode, unquote
+from collections import deque
+from urllib.parse import urlencode, unquote, urlsplit
 from aiocfscrape import CloudflareScraper
 from aiohttp_proxy import ProxyConnector
 from better_proxy import Proxy
@@ -28,16 +29,37 @@ ERROR_SLEEP_SECONDS = (180, 360)
 
 MAX_401_RETRIES = 3
 MARKET_PAGES_TO_MONITOR = 10
+MIN_PAGE_DEPTH = 2
+PAGE_DEPTH_MARGIN = 1
+PAGE_DEPTH_HISTORY = 20
+PAGE_DEPTH_FULL_SWEEP_EVERY = 10
 
 
 LONG_SLEEP_MINUTES = (60, 120)
+QUOTA_IDLE_SLEEP_SECONDS = (20, 40)
+
+
+LEDGER_COMPACT_ENTRIES = 1000
+LEDGER_ID_RETENTION_DAYS = 30
 
 
 TOKEN_LIVE_TIME_MIN = 3500
 TOKEN_LIVE_TIME_MAX = 3600
 
 
-BALANCE_CHECK_DELAY = (1, 30)
+HISTORY_PAGE_SIZE = 50
+HISTORY_START_DELAY_SECONDS = (1, 30)
+HISTORY_SYNC_MAX_PAGES = 20
+HISTORY_PAGE_DELAY_SECONDS = (1, 3)
+
+
+STREAM_CHUNK_SIZE = 4096
+STREAM_STATS_LOG_EVERY = 20
+
+
+PAGE_QUEUE_SIZE = 8
+BUY_QUEUE_SIZE = 4
+PIPELINE_REPORT_EVERY = 50
 
 init()
 
@@ -45,110 +67,239 @@ from bot.utils.universal_telegram_client import UniversalTelegramClient
 from bot.utils.proxy_utils import check_proxy, get_working_proxy
 from bot.utils.first_run import check_is_first_run, append_recurring_session
 from bot.config import settings
-from bot.utils import logger, config_utils, CONFIG_PATH
+from bot.utils import logger, config_utils, CONFIG_PATH, DATA_PATH
 from bot.exceptions import InvalidSession
+from bot.core.market_stream import (MarketItemStream, StreamLatencyStats,
+                                    StreamPageTimer)
+from bot.core.pipeline import MarketPipeline, MarketBatch, BuyCandidate
+from bot.utils.claim_registry import get_claim_registry
+from bot.core.quota import QuotaCoordinator, get_quota_coordinator
+from bot.core.balance import BalanceLedger
+from bot.core.filter_utils import (TUNING_FIELDS, FilterFile, buy_file_path,
+                                   filter_key, filter_keys, get_filter_file)
+from bot.utils.purchase_ledger import PurchaseLedger
+from bot.utils.purchase_history import PurchaseHistoryStore
+from bot.utils.observation_store import get_observation_store
+from bot.core.price_quantiles import PriceQuantileEngine, get_price_quantiles
+from bot.core.query_planner import QueryPlan, get_query_planner
+from bot.core.scan_strategy import ScanStrategy, FILTER, SUPERSET
+from bot.core.scheduler import FilterScheduler
+from bot.core.scoring import CandidateScorer
+from bot.core.filter_dsl import ItemView, compile_filter
+from bot.core.page_coordinator import get_page_coordinator
+from bot.core.change_feed import LISTING_ADDED, get_change_feed
+from bot.core.poll_controller import PollController
+from bot.core.rate_controller import (CONGESTION_STATUSES, TIME_WINDOW_SECONDS,
+                                      congestion_signal, get_rate_controller)
+from bot.core.arrival_model import get_arrival_model
+from bot.core.page_size import (PageSizeSelector, ResponseSize, aligned_pages,
+                                split_pages)
+from bot.core.hedging import RequestHedger, get_proxy_groups
 
 
 class FilterManager:
-    def __init__(self, filters: List[Dict]):
-        self._filters = filters
-        for filter_obj in self._filters:
+    def __init__(self, filters: List[Dict],
+                 quota: Optional[QuotaCoordinator] = None,
+                 session_name: Optional[str] = None,
+                 progress: Optional[Dict[str, int]] = None):
+        self._quota = quota
+        self._session_name = session_name
+        # filter key -> bought, kept for filters removed from .buy and
+        # added back later
+        self._progress: Dict[str, int] = dict(progress or {})
+        self._filters: List[Dict] = []
+        self._keys: List[str] = []
+        self._keys_by_id: Dict[int, str] = {}
+        # id -> (filter, key) of filters removed by the last reload
+        self._removed_keys: Dict[int, Tuple[Dict, str]] = {}
+        self._current_filter_index: Optional[int] = None
+        self.reload(filters)
+
+    def reload(self, filters: List[Dict]) -> Tuple[int, int]:
+        # Rejects invalid filters before anything is changed
+        for filter_obj in filters:
+            compile_filter(filter_obj)
+        # The parsed set is shared by every session using the file; progress
+        # is per session, conditions stay shared
+        filters = [dict(filter_obj) for filter_obj in filters]
+        keys = filter_keys(filters)
+
+        current = dict(zip(self._keys, self._filters))
+        merged = []
+        for filter_obj, key in zip(filters, keys):
+            kept = current.get(key)
+            if kept is not None:
+                # Unchanged filter: the same object keeps its progress and the
+                # batches and candidates that refer to it stay valid
+                for field in TUNING_FIELDS:
+                    if field in filter_obj:
+                        kept[field] = filter_obj[field]
+                    else:
+                        kept.pop(field, None)
+                kept.setdefault('quantity', 1)
+                merged.append(kept)
+                continue
             if 'quantity' not in filter_obj:
                 filter_obj['quantity'] = 1
-            filter_obj['bought'] = 0
-        self._current_filter_index = 0
+            filter_obj['bought'] = self._progress.get(key, 0)
+            merged.append(filter_obj)
+
+        current_key = (self.key_of(self.current_filter)
+                       if self.current_filter is not None else None)
+        removed = [key for key in self._keys if key not in keys]
+        added = sum(1 for key in keys if key not in current)
+        self._removed_keys = {id(current[key]): (current[key], key)
+                              for key in removed}
+        self._filters = merged
+        self._keys = keys
+        self._keys_by_id = {id(f): key for f, key in zip(merged, keys)}
+        self._current_filter_index = (keys.index(current_key)
+                                      if current_key in keys else 0)
+
+        if self._quota:
+            for filter_obj, key in zip(self._filters, self._keys):
+                self._quota.register(filter_obj, key)
+                self._quota.seed(self._session_name, key, filter_obj['bought'])
+            for key in removed:
+                self._quota.release(self._session_name, key)
+            self._claim_global_work()
+        return added, len(removed)
+
+    @property
+    def filters(self) -> List[Dict]:
+        return self._filters
 
     @property
-    def current_filter(self) -> Dict:
+    def current_filter(self) -> Optional[Dict]:
+        if self._current_filter_index is None:
+            return None
         return self._filters[self._current_filter_index]
 
     def next_filter(self) -> None:
+        if self._quota:
+            self._claim_global_work()
+            return
         self._current_filter_index = \
             (self._current_filter_index + 1) % len(self._filters)
 
-    def is_current_filter_complete(self) -> bool:
-        return (self._filters[self._current_filter_index]['bought'] >=
-                self._filters[self._current_filter_index]['quantity'])
+    def _claim_global_work(self) -> None:
+        key = self._quota.claim_work(self._session_name, self._keys)
+        self._current_filter_index = (self._keys.index(key)
+                                      if key is not None else None)
+
+    def key_of(self, filter_obj: Dict) -> str:
+        key = self._keys_by_id.get(id(filter_obj))
+        if key is not None:
+            return key
+        # Filters removed by a reload can still be referenced by a purchase
+        # in progress
+        removed = self._removed_keys.get(id(filter_obj))
+        if removed is not None and removed[0] is filter_obj:
+            return removed[1]
+        return filter_key(filter_obj)
+
+    def report_capacity(self, balance: Optional[float],
+                        rate_headroom: int) -> None:
+        if self._quota:
+            self._quota.report_capacity(self._session_name, balance,
+                                        rate_headroom)
+            if self.current_filter is not None:
+                self._quota.heartbeat(self._session_name,
+                                      self.key_of(self.current_filter))
+
+    def is_filter_complete(self, filter_obj: Dict) -> bool:
+        if id(filter_obj) not in self._keys_by_id:
+            # Removed from .buy: queued candidates for it are dropped
+            return True
+        if self._quota:
+            return self._quota.is_complete(self.key_of(filter_obj))
+        return filter_obj['bought'] >= filter_obj['quantity']
+
+    def remaining(self, filter_obj: Dict) -> int:
+        if self._quota:
+            # В глобальном режиме сессия держит не больше одной единицы квоты
+            return int(self._quota.holds(self._session_name,
+                                         self.key_of(filter_obj)))
+        return max(filter_obj['quantity'] - filter_obj['bought'], 0)
+
+    def progress(self, filter_obj: Dict) -> str:
+        if self._quota:
+            key = self.key_of(filter_obj)
+            return (f"{self._quota.bought(key)}/{self._quota.quantity(key)} "
+                    f"(все сессии)")
+        return f"{filter_obj['bought']}/{filter_obj['quantity']}"
+
+    def open_filters(self) -> List[Dict]:
+        return [f for f in self._filters if self.remaining(f) > 0]
 
     def all_filters_complete(self) -> bool:
+        if self._quota:
+            return self._quota.all_complete(self._keys)
         return all(f['bought'] >= f['quantity'] for f in self._filters)
 
-    def mark_bought(self, market_equipment_id: str, bought_ids: set) -> None:
+    def mark_bought(self, market_equipment_id: str, bought_ids: set,
+                    filter_obj: Optional[Dict] = None) -> None:
         if market_equipment_id not in bought_ids:
-            self._filters[self._current_filter_index]['bought'] += 1
+            filter_obj = filter_obj or self.current_filter
+            filter_obj['bought'] += 1
+            self._progress[self.key_of(filter_obj)] = filter_obj['bought']
             bought_ids.add(market_equipment_id)
+            if self._quota:
+                self._quota.commit(self._session_name,
+                                   self.key_of(filter_obj))
 
     def __str__(self) -> str:
         return str(self._filters)
 
 
 class ItemEvaluator:
-    def __init__(self, log_method):
+    def __init__(self, log_method, quantiles: Optional[PriceQuantileEngine] = None):
         self._log = log_method
+        self._quantiles = quantiles
+        self._last_view: Optional[ItemView] = None
 
-    def evaluate(self, item: Dict, filter_obj: Dict, bought_ids: set) -> \
-            Optional[Tuple[str, str, float, List, str]]:
-        item_name = item.get('metadata', {}).get('equipment', {}).get('name', '???')
-        stats = item.get('metadata', {}).get('equipment', {}).get(
-            'equipment_stats', [])
+    def max_price(self, filter_obj: Dict) -> Optional[float]:
+        if self._quantiles is not None:
+            return self._quantiles.max_price_for(filter_obj)
+        return filter_obj.get('max_price_tok', 1e12)
 
-        user_equipment_id = item.get('user_equipment_id')
-        market_equipment_id = item.get('id')
+    def _view(self, item: Dict, price_tok: float) -> ItemView:
+        # A listing is evaluated against every filter of its query group
+        if self._last_view is None or self._last_view.item is not item:
+            self._last_view = ItemView(item, price_tok)
+        return self._last_view
 
-        type_ok = (filter_obj.get('equipment_type', '*') == '*' or
-                   item.get('equipment_type') ==
-                   filter_obj.get('equipment_type'))
-        if not type_ok:
+    def evaluate(self, item: Dict, filter_obj: Dict, bought_ids: set) -> \
+            Optional[Tuple[str, str, float, List, str, float]]:
+        compiled = compile_filter(filter_obj)
+        if not compiled.accepts_kind(item):
             return None
 
         price_tok = float(item.get('price_gross', 0)) / 1_000_000_000
-        max_price = filter_obj.get('max_price_tok', 1e12)
-        price_ok = price_tok <= max_price
+        max_price = self.max_price(filter_obj)
+        price_ok = max_price is not None and price_tok <= max_price
         if not price_ok:
             return None
 
-        required_stats_match = True
-        used_stats_indices = set()
-        matched_stats_info = []
-
-        required_stats_filters = filter_obj.get('required_stats', [])
-        if required_stats_filters:
-            for stat_filter in required_stats_filters:
-                found_match = False
-                for idx, stat in enumerate(stats):
-                    if idx in used_stats_indices:
-                        continue
-                    if stat.get('type') == stat_filter.get('type'):
-                        stat_level = int(stat.get('level', 0))
-                        min_level = int(stat_filter.get('min_level', 0))
-                        if stat_level >= min_level:
-                            matched_stats_info.append((stat_filter, stat))
-                            used_stats_indices.add(idx)
-                            found_match = True
-                            break
-                if not found_match:
-                    required_stats_match = False
-                    break
-
-            if len(matched_stats_info) != len(required_stats_filters):
-                 required_stats_match = False
-                 self._log('debug',
-                           f"Предмет {item_name} не соответствует фильтру - не "
-                           f"все required_stats найдены или количество не "
-                           "совпадает.")
-
-
-        if not required_stats_match:
+        view = self._view(item, price_tok)
+        stat_surplus = compiled.predicate(view)
+        if stat_surplus is None:
             return None
 
+        item_name = item.get('metadata', {}).get('equipment', {}).get('name', '???')
+        market_equipment_id = item.get('id')
+
         status = 'success'
         formatted_stats = []
-        for stat_filter, stat in matched_stats_info:
-            stat_name = stat_filter['type'].replace('-', ' ').capitalize()
+        for stat in view.stats:
+            stat_type = stat.get('type')
+            if stat_type not in compiled.stat_types:
+                continue
+            stat_name = stat_type.replace('-', ' ').capitalize()
             stat_level = stat.get('level')
             stat_value = stat.get('value')
             color = self._stat_color(stat_level)
-            if 'percent' in stat_filter['type']:
+            if 'percent' in stat_type:
                 value_str = f"+{stat_value}%" if stat_value is not None else "+?"
             else:
                 value_str = f"+{stat_value}" if stat_value is not None else "+?"
@@ -160,7 +311,7 @@ class ItemEvaluator:
         self._log('info', message, status)
 
         return (item_name, market_equipment_id, price_tok, formatted_stats,
-                stats_str)
+                stats_str, stat_surplus)
 
     def _stat_color(self, level: int) -> str:
         if level >= 5:
@@ -187,16 +338,48 @@ class MarketNavigator:
         self._next_direction_change_time = time() + uniform(60, 1200)
         self._requests_in_current_direction = 0
         self._max_requests_in_random_direction = 0
+        self._sweeps = 0
 
     @property
     def current_page(self) -> int:
         return self._current_page
 
+    @property
+    def max_pages(self) -> int:
+        return self._max_pages
+
+    @max_pages.setter
+    def max_pages(self, value: int) -> None:
+        self._max_pages = value
+
+    @property
+    def sweeps(self) -> int:
+        return self._sweeps
+
+    @staticmethod
+    def _past_price_cutoff(items: List[Dict], max_price: Optional[float]) -> bool:
+        if max_price is None or not items:
+            return False
+        prices = [float(item.get('price_gross', 0)) / 1_000_000_000
+                  for item in items]
+        # Only trust the cutoff while the page really is sorted by price
+        if any(a > b for a, b in zip(prices, prices[1:])):
+            return False
+        return prices[0] > max_price
+
+    def _restart_sweep(self) -> None:
+        self._current_page = 1
+        self._sweeps += 1
+        self._next_direction_change_time = time() + uniform(60, 1200)
+        self._requests_in_current_direction = 0
+        self._max_requests_in_random_direction = 0
+
     @property
     def direction(self) -> int:
         return self._direction
 
-    def process_page_result(self, items: List[Dict]) -> None:
+    def process_page_result(self, items: List[Dict],
+                            max_price: Optional[float] = None) -> None:
         now = time()
         if not items:
             self._consecutive_empty += 1
@@ -231,15 +414,18 @@ class MarketNavigator:
 
         if self._direction == 1:
             self._current_page += 1
-            if self._current_page > self._max_pages:
-                self._log('info',
+            if self._past_price_cutoff(items, max_price):
+                self._log('debug',
+                          f"Все лоты на странице {self._current_page - 1} "
+                          f"дороже {max_price} TOK. Начинаю с первой страницы.",
+                          emoji_key='info')
+                self._restart_sweep()
+            elif self._current_page > self._max_pages:
+                self._log('debug',
                           f"Достигнут лимит страниц {self._max_pages} при "
                           f"движении вперед. Начинаю с первой страницы.",
                           emoji_key='info')
-                self._current_page = 1
-                self._next_direction_change_time = time() + uniform(60, 1200)
-                self._requests_in_current_direction = 0
-                self._max_requests_in_random_direction = 0
+                self._restart_sweep()
 
         elif self._direction == -1:
              self._current_page -= 1
@@ -254,27 +440,28 @@ class MarketNavigator:
                  self._max_requests_in_random_direction = 0
 
 
-class RateLimiter:
-    def __init__(self, request_limit: int, time_window: int, log_method):
-        self._request_limit = request_limit
-        self._time_window = time_window
-        self._log = log_method
-        self._request_times = []
-
-    async def wait_for_next_request(self) -> None:
-        now = time()
-        self._request_times = [t for t in self._request_times if now - t <
-                               self._time_window]
-
-        if len(self._request_times) >= self._request_limit:
-            sleep_time = self._time_window - (now - self._request_times[0]) + 0.5
-            self._log('debug',
-                      f"Достигнут лимит запросов ({self._request_limit}/"
-                      f"{self._time_window}s). Сон на {sleep_time:.2f}s",
-                      emoji_key='sleep')
-            await asyncio.sleep(sleep_time)
-
-        self._request_times.append(time())
+class PageDepthTracker:
+    def __init__(self, max_pages: int):
+        self._max_pages = max_pages
+        # filter key -> pages of the most recent matches
+        self._match_pages: Dict[str, deque] = {}
+
+    def record_match(self, key: str, page: int) -> None:
+        self._match_pages.setdefault(
+            key, deque(maxlen=PAGE_DEPTH_HISTORY)).append(page)
+
+    def depth(self, key: str, sweep: int,
+              expected_pages: Optional[int] = None) -> int:
+        if sweep % PAGE_DEPTH_FULL_SWEEP_EVERY == 0:
+            # Now and then walk the full range so deeper matches are noticed
+            return self._max_pages
+        pages = self._match_pages.get(key)
+        depth = self._max_pages
+        if pages:
+            depth = max(pages) + PAGE_DEPTH_MARGIN
+        elif expected_pages is not None:
+            depth = expected_pages + PAGE_DEPTH_MARGIN
+        return max(MIN_PAGE_DEPTH, min(depth, self._max_pages))
 
 
 class BaseBot:
@@ -308,6 +495,7 @@ class BaseBot:
             logger.critical(f"CHECK accounts_config.json as it might be corrupted")
             exit(-1)
         self.proxy = session_config.get('proxy')
+        self._buy_file = buy_file_path(session_config)
         if self.proxy:
             proxy = Proxy.from_str(self.proxy)
             self.tg_client.set_proxy(proxy)
@@ -397,23 +585,39 @@ class BaseBot:
                  return error_401_count + 1 # Увеличиваем счетчик, если обновление не удалось
         return error_401_count + 1 # Увеличиваем счетчик, если MAX_401_RETRIES еще не достигнут
 
-    async def make_request(self, method: str, url: str, **kwargs) -> Optional[Dict]:
+    async def make_request(self, method: str, url: str,
+                           rate_limited: bool = False,
+                           response_size: Optional[ResponseSize] = None,
+                           client: Optional[CloudflareScraper] = None,
+                           **kwargs) -> Optional[Dict]:
+        # rate_limited: the caller adapts its request rate, so 429/400 and
+        # timeouts are raised to it instead of being retried or swallowed.
+        # client: another session's proxy, for hedged requests
         if not self._http_client:
             raise InvalidSession("HTTP client not initialized")
+        http_client = client or self._http_client
         try:
             start_time = time()
             self._log('debug', f"Making {method.upper()} request to {url}")
 
-            async with getattr(self._http_client, method.lower())(url, **kwargs) as response:
+            async with getattr(http_client, method.lower())(url, **kwargs) as response:
                 duration = time() - start_time
                 status = response.status
 
                 if status == 401:
                     self.error_401_count += 1
                     self.error_401_count = await self.handle_401_error(self.error_401_count)
-                    return await self.make_request(method, url, **kwargs)
+                    return await self.make_request(method, url, rate_limited,
+                                                   response_size, client,
+                                                   **kwargs)
+
+                if rate_limited and status in CONGESTION_STATUSES:
+                    response.raise_for_status()
 
                 if status == 200:
+                    if response_size is not None:
+                        response_size.start(response)
+                        response_size.add(await response.read())
                     json_resp = await response.json()
                     self._log(
                         'debug',
@@ -426,13 +630,18 @@ class BaseBot:
                 return None
 
         except aiohttp.ClientError as e:
+            if rate_limited and congestion_signal(e) is not None:
+                raise
             error_msg = f"Сетевая ошибка при выполнении запроса: {str(e)}\n{traceback.format_exc()}"
             self._log('error', error_msg)
             self._log('debug', f"Request {method.upper()} {url} | Error: {str(e)}")
             await asyncio.sleep(RETRY_DELAY_SECONDS)
-            return await self.make_request(method, url, **kwargs)
+            return await self.make_request(method, url, rate_limited,
+                                           response_size, client, **kwargs)
 
         except Exception as e:
+            if rate_limited and congestion_signal(e) is not None:
+                raise
             error_msg = f"Критическая ошибка при выполнении запроса: {str(e)}\n{traceback.format_exc()}"
             self._log('error', error_msg)
             self._log('debug', f"Request {method.upper()} {url} | Error: {str(e)}")
@@ -477,11 +686,32 @@ class MarketMonitorBot(BaseBot):
             'User-Agent': session_config.get('user_agent'),
             'Accept': 'application/json, text/plain, */*',
             'Accept-Language': 'en-US,en;q=0.9',
+            'Accept-Encoding': 'gzip, deflate',
             'Content-Type': 'application/json'
         }
         self.access_token_created_time = 0
         self._current_ref_id = None
-        self._item_evaluator = ItemEvaluator(self._log)
+        self._price_quantiles = get_price_quantiles()
+        self._query_planner = get_query_planner()
+        self._page_depth = PageDepthTracker(MARKET_PAGES_TO_MONITOR)
+        self._scan_strategy = ScanStrategy(settings.SCAN_STRATEGY)
+        self._filter_scheduler = FilterScheduler()
+        self._page_coordinator = get_page_coordinator()
+        self._change_feed = get_change_feed()
+        self._arrival_model = get_arrival_model()
+        self._item_evaluator = ItemEvaluator(self._log, self._price_quantiles)
+        self._scorer = CandidateScorer(self._price_quantiles)
+        self._stream_stats = StreamLatencyStats()
+        self._claims = get_claim_registry()
+        self._balance_ledger = BalanceLedger(self._log)
+        self._purchase_ledger = PurchaseLedger(
+            os.path.join(DATA_PATH, 'ledger', f"{self.session_name}.jsonl"))
+        self._purchase_history = PurchaseHistoryStore(
+            os.path.join(DATA_PATH, 'history'), self.session_name)
+        self._observations = get_observation_store()
+        proxy_groups = get_proxy_groups()
+        self._hedger = (RequestHedger(self.session_name, proxy_groups)
+                        if proxy_groups is not None else None)
 
     def get_ref_id(self) -> str:
         if self._current_ref_id is None:
@@ -511,7 +741,6 @@ class MarketMonitorBot(BaseBot):
             raise InvalidSession("Критическая ошибка при получении TG Web Data")
 
     async def users_balance(self) -> Optional[float]:
-        await asyncio.sleep(uniform(*BALANCE_CHECK_DELAY))
         url = 'https://liyue.tonkombat.com/api/v1/users/balance'
         headers = {
             **self.headers,
@@ -534,30 +763,63 @@ class MarketMonitorBot(BaseBot):
             return None
 
     async def get_purchase_history(self, page: int = 1, page_size: int = 50) -> Optional[List[dict]]:
-        await asyncio.sleep(uniform(*BALANCE_CHECK_DELAY))
         url = f"https://liyue.tonkombat.com/api/v1/market-equipment-history/me?page={page}&page_size={page_size}"
         headers = {
             **self.headers,
             'Authorization': f'tma {self._init_data}'
         }
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    url=url,
-                    headers=headers,
-                    ssl=False,
-                    timeout=aiohttp.ClientTimeout(total=20)
-                ) as response:
-                    response.raise_for_status()
-                    result = await response.json()
-                    items = result.get('data', {}).get('items', [])
-                    for item in items:
-                        name = item.get('metadata', {}).get('equipment', {}).get('name', 'Unknown')
-                        price = float(item.get('price_gross', 0)) / 1_000_000_000
-                        self._log('info', f"Покупка: {name} за {price:.2f} TOK", 'equipment')
-                    return items
-        except Exception:
+
+        async def send(client: Optional[CloudflareScraper] = None):
+            return await self.make_request(method='get', url=url, client=client,
+                                           headers=headers, ssl=False,
+                                           timeout=aiohttp.ClientTimeout(total=20))
+
+        if self._hedger is not None:
+            result, _ = await self._hedger.run(send, urlsplit(url).path,
+                                               self._current_proxy)
+        else:
+            result = await send()
+        if result is None:
             return None
+        return result.get('data', {}).get('items', [])
+
+    async def sync_purchase_history(self) -> Optional[int]:
+        new_entries = []
+        for page in range(1, HISTORY_SYNC_MAX_PAGES + 1):
+            items = await self.get_purchase_history(page, HISTORY_PAGE_SIZE)
+            if items is None:
+                return None
+            fresh, reached_cursor = self._purchase_history.take_until_cursor(items)
+            new_entries.extend(fresh)
+            if reached_cursor or len(items) < HISTORY_PAGE_SIZE:
+                break
+            await asyncio.sleep(uniform(*HISTORY_PAGE_DELAY_SECONDS))
+
+        await asyncio.to_thread(self._purchase_history.append, new_entries)
+        for item in reversed(new_entries):
+            name = item.get('metadata', {}).get('equipment', {}).get('name', 'Unknown')
+            price = float(item.get('price_gross', 0)) / 1_000_000_000
+            self._log('info', f"Покупка: {name} за {price:.2f} TOK", 'equipment')
+        return len(new_entries)
+
+    async def _purchase_history_loop(self) -> None:
+        # Low priority: long interval, random start offset and pauses between
+        # pages so it never competes with the market scan for bursts
+        await asyncio.sleep(uniform(*HISTORY_START_DELAY_SECONDS))
+        while True:
+            try:
+                new_count = await self.sync_purchase_history()
+                if new_count is not None:
+                    total, spent = await asyncio.to_thread(
+                        self._purchase_history.report)
+                    self._log('debug', f"История покупок: новых {new_count}, "
+                                       f"всего {total} на {spent:.2f} TOK",
+                              emoji_key='equipment')
+            except InvalidSession:
+                raise
+            except Exception as e:
+                self._log('debug', f"Ошибка синхронизации истории покупок: {e}")
+            await asyncio.sleep(settings.HISTORY_SYNC_INTERVAL)
 
     async def buy_equipment(self, market_equipment_id: str, attempt: int = 1, max_attempts: int = 3) -> bool:
         url = 'https://liyue.tonkombat.com/api/v1/market/equipment/buy'
@@ -593,91 +855,461 @@ class MarketMonitorBot(BaseBot):
             self._log('error', f'Ошибка при покупке: {e}')
             return False
 
-    async def debug_monitor_market(self, page_size: int = 20):
-        REQUEST_LIMIT = 25
-        TIME_WINDOW = 60
-        ERROR_400_THRESHOLD = 5
+    async def stream_market_page(self, url: str, headers: Dict, on_item,
+                                 timer: Optional[StreamPageTimer] = None,
+                                 response_size: Optional[ResponseSize] = None
+                                 ) -> Optional[List[Dict]]:
+        if not self._http_client:
+            raise InvalidSession("HTTP client not initialized")
+        timer = timer or StreamPageTimer()
+        stream = MarketItemStream()
+        items = []
+        self._log('debug', f"Making streaming GET request to {url}")
+
+        async with self._http_client.get(
+                url, headers=headers, ssl=False,
+                timeout=aiohttp.ClientTimeout(total=20)) as response:
+            status = response.status
+            if status == 401:
+                self.error_401_count += 1
+                self.error_401_count = await self.handle_401_error(
+                    self.error_401_count)
+                headers = {**headers, 'Authorization': f'tma {self._init_data}'}
+                return await self.stream_market_page(url, headers, on_item,
+                                                     timer, response_size)
+
+            if status in CONGESTION_STATUSES:
+                response.raise_for_status()
+            if status != 200:
+                self._log('debug', f"Request GET {url} failed with status "
+                                   f"{status} | Duration: "
+                                   f"{time() - timer.started:.2f}s")
+                return None
 
-        try:
-            with open('.buy', 'r', encoding='utf-8') as f:
-                filters_data = json.load(f)
-            filter_manager = FilterManager(filters_data)
-        except Exception as e:
-            self._log('error', f"Ошибка чтения .buy: {e}", emoji_key='error')
+            if response_size is not None:
+                response_size.start(response)
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                if response_size is not None:
+                    response_size.add(chunk)
+                for item in stream.feed(chunk):
+                    timer.item_ready()
+                    items.append(item)
+                    await on_item(item, timer)
+
+        body_complete_time = timer.body_complete()
+        if not stream.found_items:
+            self._log('debug', f"В потоковом ответе {url} не найден "
+                               f"массив data.items")
+        self._log('debug', f"Потоковый разбор: {len(items)} предметов за "
+                           f"{body_complete_time - timer.started:.2f}s")
+        return items
+
+    def _record_stream_page(self, timer: StreamPageTimer) -> None:
+        if timer.body_complete_time is None:
             return
+        self._stream_stats.record_page(timer.body_complete_time,
+                                       timer.first_item_time,
+                                       timer.match_times)
+        if self._stream_stats.pages % STREAM_STATS_LOG_EVERY == 0:
+            self._log('info', f"Потоковый разбор рынка: "
+                              f"{self._stream_stats.summary()}")
+
+    def _record_buy_result(self, ok: bool, candidate: BuyCandidate,
+                           bought_ids: set,
+                           filter_manager: FilterManager) -> None:
+        filter_obj = candidate.filter_obj
+        if not ok:
+            self._log('error',
+                      f"Покупка не удалась: {candidate.item_name} "
+                      f"({candidate.market_equipment_id})")
+            return
+        filter_manager.mark_bought(candidate.market_equipment_id, bought_ids,
+                                   filter_obj)
+        self._purchase_ledger.record(candidate.market_equipment_id,
+                                     filter_manager.key_of(filter_obj),
+                                     candidate.price_tok)
+        self._log('success',
+                  f"Успешно куплено: {candidate.item_name} "
+                  f"({candidate.market_equipment_id}). Куплено "
+                  f"{filter_manager.progress(filter_obj)}.")
+        if filter_manager.is_filter_complete(filter_obj):
+            self._log('success',
+                      f"Задача для фильтра {filter_obj} "
+                      f"выполнена. Куплено "
+                      f"{filter_manager.progress(filter_obj)}.",
+                      emoji_key='success')
+
+    @staticmethod
+    def _base_query_params(filter_obj: Dict) -> Dict:
+        params = {}
+        if 'equipment_type' in filter_obj and \
+                filter_obj['equipment_type'] != '*':
+            params['market_type'] = filter_obj['equipment_type']
+        if 'rarity' in filter_obj:
+            params['rarity'] = filter_obj['rarity']
+        return params
+
+    def _query_group(self, filter_manager: FilterManager,
+                     current_filter: Dict,
+                     statistic: Optional[str]) -> List[Dict]:
+        # Filters whose listings all come back from the current query: same
+        # type/rarity, and the query statistic is one of their required stats
+        base_params = self._base_query_params(current_filter)
+        group = [current_filter]
+        for filter_obj in filter_manager.open_filters():
+            if filter_obj is current_filter or \
+                    self._base_query_params(filter_obj) != base_params:
+                continue
+            stat_types = {stat.get('type')
+                          for stat in filter_obj.get('required_stats') or []}
+            if (statistic in stat_types) if statistic else not stat_types:
+                group.append(filter_obj)
+        return group
+
+    def _page_query_key(self, filter_obj: Dict, strategy: str,
+                        statistic: Optional[str], page_size: int) -> Tuple:
+        if strategy == SUPERSET:
+            return SUPERSET, page_size
+        return (tuple(sorted(self._base_query_params(filter_obj).items())),
+                statistic, page_size)
+
+    def _build_superset_url(self, current_page: int, page_size: int) -> str:
+        params = {
+            'page': current_page,
+            'page_size': page_size,
+            'sort_by_price': 'asc',
+        }
+        self._log('debug', f"Параметры запроса: {params}")
+        return (f"https://liyue.tonkombat.com/api/v1/market/equipment?"
+                f"{urlencode(params)}")
+
+    def _build_market_url(self, current_filter: Dict, current_page: int,
+                          page_size: int,
+                          plan: Optional[QueryPlan] = None) -> str:
+        params = {
+            'page': current_page,
+            'page_size': page_size,
+            **self._base_query_params(current_filter),
+        }
 
-        market_navigator = MarketNavigator(MARKET_PAGES_TO_MONITOR, self._log)
-        rate_limiter = RateLimiter(REQUEST_LIMIT, TIME_WINDOW, self._log)
-        bought_ids = set()
-        error_400_count = 0
+        if plan is not None:
+            statistic, sort_by_statistic = (plan.statistic,
+                                            plan.sort_by_statistic)
+        elif current_filter.get('required_stats'):
+            statistic = current_filter['required_stats'][0]['type']
+            sort_by_statistic = 'desc'
+        else:
+            statistic = sort_by_statistic = None
+        if statistic:
+            params['statistic'] = statistic
 
-        self._log('debug', f"Старт мониторинга рынка. Фильтры: "
-                           f"{filter_manager}", emoji_key='debug')
+        params['sort_by_price'] = 'asc'
 
-        while True:
-            if filter_manager.is_current_filter_complete():
-                 self._log('debug',
-                           "Задача для текущего фильтра выполнена. "
-                           "Переход к следующему.")
-                 filter_manager.next_filter()
-                 if filter_manager.all_filters_complete():
-                     self._log('success',
-                               'Все задачи по мониторингу выполнены.',
-                               emoji_key='success')
-                     raise InvalidSession('Все задачи по мониторингу выполнены.')
-                 # Reset navigation/rate limiter for the new filter?
-                 # Decide if RateLimiter/Navigator state should persist across filters
-                 market_navigator = MarketNavigator(MARKET_PAGES_TO_MONITOR, self._log)
-                 rate_limiter = RateLimiter(REQUEST_LIMIT, TIME_WINDOW, self._log)
-                 await asyncio.sleep(uniform(2, 4)) # Small delay between filters
-                 continue
+        if sort_by_statistic:
+            params['sort_by_statistic'] = sort_by_statistic
 
+        self._log('debug', f"Параметры запроса: {params}")
 
-            current_filter = filter_manager.current_filter
-            current_page = market_navigator.current_page
-            direction = market_navigator.direction
+        return (f"https://liyue.tonkombat.com/api/v1/market/equipment?"
+                f"{urlencode(params)}")
 
-            self._log('debug',
-                      f"Текущий фильтр: {current_filter}, страница: "
-                      f"{current_page}, направление: {direction}")
+    def _plan_query(self, filter_manager: FilterManager, filter_obj: Dict,
+                    page_size: int, chosen: Dict[str, str]) -> Optional[QueryPlan]:
+        if self._query_planner is None:
+            return None
+        plan = self._query_planner.plan(filter_obj, page_size)
+        key = filter_manager.key_of(filter_obj)
+        if plan.statistic and chosen.get(key) != plan.statistic:
+            if key in chosen:
+                self._log('info', f"Планировщик запросов: фильтр "
+                                  f"{filter_obj.get('required_stats')} → {plan}",
+                          emoji_key='info')
+            chosen[key] = plan.statistic
+        return plan
+
+    def _log_filter_metrics(self, filter_manager: FilterManager) -> None:
+        for filter_obj in filter_manager.filters:
+            key = filter_manager.key_of(filter_obj)
+            self._log('info', f"Фильтр {filter_obj.get('equipment_type')}/"
+                              f"{filter_obj.get('rarity')} "
+                              f"{filter_obj.get('required_stats')}: "
+                              f"{self._filter_scheduler.report(key)}, куплено "
+                              f"{filter_manager.progress(filter_obj)}",
+                      emoji_key='info')
+
+    @staticmethod
+    def _arrival_groups(filter_manager: FilterManager
+                        ) -> List[Tuple[str, Optional[str]]]:
+        return [(f.get('equipment_type', '*'), f.get('rarity'))
+                for f in filter_manager.open_filters()]
+
+    def _log_arrival_forecast(self, filter_manager: FilterManager) -> None:
+        groups = self._arrival_groups(filter_manager)
+        rate = self._arrival_model.rate(groups)
+        if rate is None:
+            return
+        self._log('info', f"Прогноз новых лотов: {rate * 60:.2f}/мин, "
+                          f"множитель задержки "
+                          f"{self._arrival_model.delay_factor(groups):.2f}",
+                  emoji_key='info')
+
+    def _log_query_plans(self, filter_manager: FilterManager,
+                         page_size: int) -> None:
+        if self._query_planner is None:
+            return
+        for filter_obj in filter_manager.filters:
+            plan = self._query_planner.plan(filter_obj, page_size)
+            self._log('info', f"План запроса для {filter_obj.get('equipment_type')}"
+                              f"/{filter_obj.get('rarity')} "
+                              f"{filter_obj.get('required_stats')}: {plan}",
+                      emoji_key='info')
+
+    async def _load_purchase_ledger(self) -> Tuple[Dict[str, int], set]:
+        progress, bought_ids = await asyncio.to_thread(
+            self._purchase_ledger.load)
+        if self._purchase_ledger.entries >= LEDGER_COMPACT_ENTRIES:
+            await asyncio.to_thread(self._purchase_ledger.compact,
+                                    LEDGER_ID_RETENTION_DAYS * 86400)
+        if bought_ids:
+            self._log('info', f"Восстановлено из журнала покупок: "
+                              f"{len(bought_ids)} лотов", emoji_key='info')
+        return progress, bought_ids
 
-            params = {
-                'page': current_page,
-                'page_size': page_size,
-            }
+    async def debug_monitor_market(self, page_size: int = 20):
+        progress, bought_ids = await self._load_purchase_ledger()
+        filter_file = get_filter_file(self._buy_file)
+        try:
+            filter_file.refresh()
+            filter_manager = FilterManager(filter_file.filters,
+                                           get_quota_coordinator(),
+                                           self.session_name, progress)
+        except Exception as e:
+            sleep_duration = uniform(*ERROR_SLEEP_SECONDS)
+            self._log('error', f"Ошибка чтения {filter_file.path}: {e}. "
+                               f"Сон на {int(sleep_duration)}s.",
+                      emoji_key='error')
+            await asyncio.sleep(sleep_duration)
+            return
+
+        pipeline = MarketPipeline(PAGE_QUEUE_SIZE, BUY_QUEUE_SIZE)
+        if self._change_feed is not None and settings.MARKET_PRICE_DROP_ALERT > 0:
+            self._change_feed.ensure_price_alerts(
+                settings.MARKET_PRICE_DROP_ALERT)
 
-            if 'equipment_type' in current_filter and \
-                    current_filter['equipment_type'] != '*':
-                params['market_type'] = current_filter['equipment_type']
-            if 'rarity' in current_filter:
-                params['rarity'] = current_filter['rarity']
+        self._log('debug', f"Старт мониторинга рынка. Фильтры: "
+                           f"{filter_manager}", emoji_key='debug')
+
+        try:
+            await pipeline.run(
+                self._market_fetch_stage(pipeline, filter_manager, page_size),
+                self._market_evaluate_stage(pipeline, filter_manager,
+                                            bought_ids),
+                self._market_buy_stage(pipeline, filter_manager, bought_ids),
+                self._watch_filter_file(filter_file, filter_manager),
+                self._purchase_ledger.run())
+        finally:
+            if self._hedger is not None:
+                await self._hedger.close()
+
+    async def _watch_filter_file(self, filter_file: FilterFile,
+                                 filter_manager: FilterManager) -> None:
+        if settings.BUY_RELOAD_INTERVAL <= 0:
+            return
+        # The file is shared: whichever session notices the edit first
+        # re-reads it, every session applies the new version
+        applied = filter_file.version
+        while True:
+            await asyncio.sleep(settings.BUY_RELOAD_INTERVAL)
+            try:
+                filter_file.refresh()
+                if filter_file.version == applied:
+                    continue
+                applied = filter_file.version
+                added, removed = filter_manager.reload(filter_file.filters)
+            except Exception as e:
+                self._log('warning', f"Изменения {filter_file.path} не "
+                                     f"применены, работаю по прежним "
+                                     f"фильтрам: {e}", emoji_key='warning')
+                continue
+            self._log('info', f"Фильтры {filter_file.path} перезагружены: "
+                              f"всего {len(filter_manager.filters)}, новых "
+                              f"{added}, удалено {removed}", emoji_key='info')
 
-            has_statistic = ('required_stats' in current_filter and
-                             current_filter['required_stats'])
-            if has_statistic:
-                params['statistic'] = current_filter['required_stats'][0]['type']
+    async def _market_fetch_stage(self, pipeline: MarketPipeline,
+                                  filter_manager: FilterManager,
+                                  page_size: int) -> None:
+        ERROR_400_THRESHOLD = 5
 
-            params['sort_by_price'] = 'asc'
+        # Page position per filter, since filters are scanned interleaved
+        filter_navigators: Dict[str, MarketNavigator] = {}
+        superset_navigator = MarketNavigator(MARKET_PAGES_TO_MONITOR, self._log)
+        rate_controller = get_rate_controller()
+        rate_limiter = None
+        # Page numbers everywhere stay in pages of page_size; a request may
+        # cover several of them
+        page_sizes = PageSizeSelector(page_size, settings.MARKET_PAGE_SIZE_MAX,
+                                      settings.MARKET_PAGE_LATENCY_TARGET,
+                                      settings.ADAPTIVE_PAGE_SIZE)
+        poll_controller = None
+        if settings.ADAPTIVE_POLLING:
+            poll_controller = PollController(
+                settings.MARKET_RATE_LIMIT, TIME_WINDOW_SECONDS,
+                sum(settings.MARKET_MONITOR_DELAY_SECONDS) / 2,
+                settings.ADAPTIVE_POLL_MAX_DELAY)
+        error_400_count = 0
+        chosen_statistics: Dict[str, str] = {}
 
-            if has_statistic:
-                params['sort_by_statistic'] = 'desc'
+        while True:
+            filter_manager.report_capacity(
+                self._balance_ledger.available,
+                rate_limiter.headroom() if rate_limiter is not None
+                else settings.MARKET_RATE_LIMIT)
+            open_filters = filter_manager.open_filters()
+            if not open_filters:
+                if filter_manager.all_filters_complete():
+                    self._log('success',
+                              'Все задачи по мониторингу выполнены.',
+                              emoji_key='success')
+                    raise InvalidSession('Все задачи по мониторингу выполнены.')
+                # Global quotas: lease the next unit, unless every open unit
+                # is leased to other sessions
+                filter_manager.next_filter()
+                if not filter_manager.open_filters():
+                    sleep_duration = uniform(*QUOTA_IDLE_SLEEP_SECONDS)
+                    self._log('debug', f"Свободных единиц квоты нет. Повторная "
+                                       f"проверка через {int(sleep_duration)}s",
+                              emoji_key='sleep')
+                    await asyncio.sleep(sleep_duration)
+                continue
 
-            self._log('debug', f"Параметры запроса: {params}")
+            current_filter = self._filter_scheduler.next(open_filters,
+                                                         filter_manager.key_of)
+            strategy = self._scan_strategy.choose()
+            if strategy == SUPERSET:
+                # One broad query sorted by price, every open filter is
+                # matched locally
+                market_navigator = superset_navigator
+                plan = statistic = None
+                group = filter_manager.open_filters()
+                depth_keys = [SUPERSET]
+            else:
+                market_navigator = filter_navigators.setdefault(
+                    filter_manager.key_of(current_filter),
+                    MarketNavigator(MARKET_PAGES_TO_MONITOR, self._log))
+                plan = self._plan_query(filter_manager, current_filter,
+                                        page_size, chosen_statistics)
+                if plan is not None:
+                    statistic = plan.statistic
+                else:
+                    required_stats = current_filter.get('required_stats')
+                    statistic = (required_stats[0]['type']
+                                 if required_stats else None)
+                group = self._query_group(filter_manager, current_filter,
+                                          statistic)
+                depth_keys = [filter_manager.key_of(f) for f in group]
+
+            query_key = self._page_query_key(current_filter, strategy,
+                                             statistic, page_size)
+            if self._page_coordinator is not None:
+                # Sessions scanning the same query split its pages
+                sweeps = self._page_coordinator.sweeps(query_key)
+                lease = self._page_coordinator.lease(
+                    query_key, self.session_name,
+                    max(self._page_depth.depth(
+                        depth_key, sweeps,
+                        plan.expected_pages if plan else None)
+                        for depth_key in depth_keys),
+                    page_sizes.desired_pages())
+                if lease is None:
+                    self._filter_scheduler.defer(group, filter_manager.key_of)
+                    await asyncio.sleep(
+                        uniform(*settings.MARKET_MONITOR_DELAY_SECONDS))
+                    continue
+                current_page, pages = lease
+            else:
+                current_page = market_navigator.current_page
+                pages = (aligned_pages(current_page, page_sizes.desired_pages(),
+                                       market_navigator.max_pages)
+                         if market_navigator.direction == 1 else 1)
+            direction = market_navigator.direction
 
-            url = (f"https://liyue.tonkombat.com/api/v1/market/equipment?"
-                   f"{urlencode(params)}")
+            self._log('debug',
+                      f"Текущий фильтр: {current_filter}, стратегия: "
+                      f"{strategy}, страница: {current_page}, страниц в "
+                      f"запросе: {pages}, направление: {direction}")
+
+            request_page = (current_page - 1) // pages + 1
+            if strategy == SUPERSET:
+                url = self._build_superset_url(request_page,
+                                               pages * page_size)
+            else:
+                url = self._build_market_url(current_filter, request_page,
+                                             pages * page_size, plan)
             headers = {
                 **self.headers,
                 'Authorization': f'tma {self._init_data}'
             }
+            # The server limit is learned separately per endpoint and proxy
+            rate_limiter = rate_controller.limiter(urlsplit(url).path,
+                                                   self._current_proxy,
+                                                   self.session_name)
 
             try:
-                await rate_limiter.wait_for_next_request()
-                result = await self.make_request(method='get', url=url,
-                                                 headers=headers, ssl=False,
-                                                 timeout=aiohttp.ClientTimeout(total=20))
-
-                if result is None:
+                await rate_limiter.wait_for_next_request(self._log)
+                started = time()
+                response_size = ResponseSize()
+                hedged = False
+                if settings.MARKET_STREAM_PARSE:
+                    streamed = 0
+
+                    # Listings are dispatched one by one as they are read,
+                    # so a page is not ranked best-first in this mode
+                    async def on_item(item: Dict, timer: StreamPageTimer) -> None:
+                        nonlocal streamed
+                        item_page = current_page + streamed // page_size
+                        streamed += 1
+                        await pipeline.batches.put(
+                            MarketBatch(group, item_page, [item],
+                                        timer, page_done=False,
+                                        strategy=strategy))
+
+                    timer = StreamPageTimer()
+                    items = await self.stream_market_page(url, headers,
+                                                          on_item, timer,
+                                                          response_size)
+                    if items is not None:
+                        await pipeline.batches.put(
+                            MarketBatch(group, current_page, [],
+                                        timer, strategy=strategy))
+                else:
+                    async def send(client: Optional[CloudflareScraper] = None):
+                        return await self.make_request(
+                            method='get', url=url, rate_limited=True,
+                            response_size=response_size if client is None
+                            else None,
+                            client=client, headers=headers, ssl=False,
+                            timeout=aiohttp.ClientTimeout(total=20))
+
+                    if self._hedger is not None:
+                        # A duplicate through another proxy of the group
+                        # once the request is slower than usual
+                        result, hedged = await self._hedger.run(
+                            send, urlsplit(url).path, self._current_proxy,
+                            rate_limiter)
+                    else:
+                        result = await send()
+                    items = (result.get('data', {}).get('items', [])
+                             if result is not None else None)
+                    for offset, page_items in enumerate(
+                            split_pages(items or [], page_size, pages)):
+                        if page_items:
+                            await pipeline.batches.put(
+                                MarketBatch(group, current_page + offset,
+                                            page_items, strategy=strategy))
+                latency = time() - started
+                pipeline.fetcher.record(latency)
+
+                if items is None:
                      self._log('warning', "make_request вернул None. Пропускаем "
                                           "обработку ответа и продолжаем цикл.",
                                emoji_key='warning')
@@ -685,37 +1317,139 @@ class MarketMonitorBot(BaseBot):
                      continue
 
                 error_400_count = 0
+                rate_limiter.record_success()
+                page_sizes.record(pages, latency, len(items),
+                                  None if hedged else response_size)
+                if page_sizes.record_sequence(query_key, current_page, pages,
+                                              len(items)):
+                    self._log('warning', f"Сервер отдаёт не больше "
+                                         f"{page_sizes.cap} лотов за запрос, "
+                                         f"размер страницы уменьшен",
+                              emoji_key='warning')
+                self._scan_strategy.record_request(strategy, len(items))
+                self._filter_scheduler.record_scan(group, filter_manager.key_of)
 
-                items = result.get('data', {}).get('items', [])
                 self._log('debug', f"Найдено предметов: {len(items)} на странице "
                                    f"{current_page}")
 
-                market_navigator.process_page_result(items)
-
-                if items:
-                    self._log('debug', f"Передаю {len(items)} предметов в "
-                                       f"_analyze_items")
-                    await self._analyze_items(items, current_filter,
-                                               current_page, bought_ids,
-                                               filter_manager)
-
-
-                # Original page logic moved to MarketNavigator
-                # Original delay logic left here for now as it depends on global setting
-                delay_time = uniform(*settings.MARKET_MONITOR_DELAY_SECONDS)
+                if self._observations and items:
+                    self._observations.observe(items)
+                if self._price_quantiles and items:
+                    self._price_quantiles.observe(items)
+                if self._query_planner:
+                    self._query_planner.observe(items, statistic)
+
+                # Paging stops only at explicit caps: a quantile limit comes
+                # from the prices seen, and pruning them would drag it down
+                cutoffs = [filter_obj.get('max_price_tok') for filter_obj in group]
+                max_price = None if None in cutoffs else max(cutoffs)
+                if self._arrival_model is not None:
+                    self._arrival_model.record_activity()
+                    self._arrival_model.ensure_training(self._observations)
+
+                # Page bookkeeping runs per page covered, as if each had been
+                # requested on its own, and stops where the sweep would
+                arrivals = 0
+                for offset, page_items in enumerate(
+                        split_pages(items, page_size, pages)):
+                    page = current_page + offset
+                    if self._query_planner:
+                        self._query_planner.record_page(
+                            current_filter, statistic, page, len(page_items),
+                            page_size)
+                    if self._change_feed is not None:
+                        arrivals += sum(
+                            1 for event in self._change_feed.observe(
+                                query_key, page, page_items)
+                            if event.kind == LISTING_ADDED and
+                            not event.initial)
+
+                    if self._page_coordinator is not None:
+                        if not page_items or MarketNavigator._past_price_cutoff(
+                                page_items, max_price):
+                            self._page_coordinator.end_of_results(query_key,
+                                                                  page)
+                            break
+                    else:
+                        market_navigator.max_pages = max(
+                            self._page_depth.depth(
+                                depth_key, market_navigator.sweeps,
+                                plan.expected_pages if plan else None)
+                            for depth_key in depth_keys)
+                        market_navigator.process_page_result(page_items,
+                                                             max_price)
+                        if market_navigator.current_page != page + 1:
+                            break
+                if poll_controller is not None:
+                    poll_controller.record_poll(query_key, current_page,
+                                                arrivals)
+
+                if pipeline.fetcher.processed % PIPELINE_REPORT_EVERY == 0:
+                    self._log('info', f"Конвейер рынка: {pipeline.summary()}")
+                    self._log_query_plans(filter_manager, page_size)
+                    self._log_filter_metrics(filter_manager)
+                    if settings.SCAN_STRATEGY != FILTER:
+                        self._log('info', f"Стратегии сканирования: "
+                                          f"{self._scan_strategy.summary()}")
+                    if self._page_coordinator is not None:
+                        summary = self._page_coordinator.summary(query_key)
+                        self._log('info', f"Совместное сканирование запроса: "
+                                          f"{summary}")
+                    if self._change_feed is not None:
+                        turnover = self._change_feed.summary(query_key)
+                        self._log('info', f"Оборот лотов запроса: {turnover}")
+                    self._log('info', f"Лимит запросов рынка: "
+                                      f"{rate_limiter.summary()}")
+                    self._log('info', f"Размер страницы рынка: "
+                                      f"{page_sizes.summary()}")
+                    if self._hedger is not None:
+                        self._log('info', f"Дублирующие запросы: "
+                                          f"{self._hedger.summary()}")
+                    if poll_controller is not None:
+                        self._log('info', f"Опрос рынка: "
+                                          f"{poll_controller.summary()}")
+                    if self._arrival_model is not None:
+                        self._log_arrival_forecast(filter_manager)
+
+                if poll_controller is not None:
+                    # Faster while listings keep arriving, slower when quiet
+                    poll_controller.set_request_limit(
+                        rate_limiter.session_limit, rate_limiter.time_window)
+                    delay_time = poll_controller.delay()
+                else:
+                    delay_time = uniform(*settings.MARKET_MONITOR_DELAY_SECONDS)
+                if self._arrival_model is not None:
+                    # The request budget moves to the hours when new
+                    # listings are expected
+                    delay_time *= self._arrival_model.delay_factor(
+                        self._arrival_groups(filter_manager))
+                    if poll_controller is not None:
+                        delay_time = max(delay_time, poll_controller.min_delay)
                 self._log('debug',
-                          f"Задержка перед следующим запросом к рынку согласно "
-                          f"настройкам: {delay_time:.2f} с", emoji_key='sleep')
+                          f"Задержка перед следующим запросом к рынку: "
+                          f"{delay_time:.2f} с", emoji_key='sleep')
                 await asyncio.sleep(delay_time)
 
 
-            except aiohttp.ClientError as e:
-                if isinstance(e, aiohttp.ClientResponseError) and e.status == 400:
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                signal = congestion_signal(e)
+                if signal is not None:
+                    if rate_limiter.record_congestion(started, signal):
+                        self._log('warning',
+                                  f"Сервер рынка ограничивает запросы "
+                                  f"({signal}): лимит снижен до "
+                                  f"{int(rate_limiter.limit)}/"
+                                  f"{rate_limiter.time_window} с",
+                                  emoji_key='warning')
+                if signal == 400:
                     self._log('warning',
                               f"Получена ошибка 400 (Bad Request) при "
                               f"получении рынка: {e}", emoji_key='warning')
                     error_400_count += 1
-                    if error_400_count >= ERROR_400_THRESHOLD:
+                    # 400s that go on at the lowest request rate are not
+                    # throttling: the session needs a restart
+                    if error_400_count >= ERROR_400_THRESHOLD and \
+                            rate_limiter.at_floor:
                         self._log('error',
                                   f"Получено {error_400_count} последовательных "
                                   f"ошибок 400. Завершаю сессию для перезапуска.",
@@ -730,6 +1464,8 @@ class MarketMonitorBot(BaseBot):
                                            f"{error_400_count}. Короткий сон.",
                                            emoji_key='sleep')
                         await asyncio.sleep(uniform(10, 20))
+                elif signal is not None:
+                    await asyncio.sleep(uniform(10, 20))
                 else:
                     self._log('error',
                               f"Ошибка при получении рынка (после make_request "
@@ -749,60 +1485,135 @@ class MarketMonitorBot(BaseBot):
                  await asyncio.sleep(uniform(60, 120))
                  continue
 
-            # This check is now handled by FilterManager and InvalidSession exception
-            # if all(f['bought'] >= f['quantity'] for f in filters):
-            #     self._log('success', 'Все задачи по мониторингу выполнены.', emoji_key='success')
-            #     raise InvalidSession('Все задачи по мониторингу выполнены.')
-
-
-    async def _analyze_items(self, items, filter_obj, current_page, \
-                              bought_ids, filter_manager: FilterManager):
-
-        self._log('debug', f"Анализ предметов на странице {current_page}, "
-                           f"фильтр: {filter_obj}")
-        for item in items:
-            evaluation_result = self._item_evaluator.evaluate(item, filter_obj, \
-                                                              bought_ids)
-
-            if evaluation_result:
-                (item_name, market_equipment_id, price_tok, formatted_stats,
-                 stats_str) = evaluation_result
-                status = 'success'
-                price_info = "✅ цена"
-                message = (f"{item_name} [market_id:{market_equipment_id}] "
-                           f"({stats_str}) | {price_info} {price_tok:.1f} TOK")
-                self._log('info', message, status)
-
-                if market_equipment_id and market_equipment_id not in bought_ids:
-                    self._log('debug', f"Пробую купить: {item_name} "
-                                       f"({market_equipment_id}) за "
-                                       f"{price_tok:.1f} TOK")
-                    ok = await self.buy_equipment(market_equipment_id)
-                    if ok:
-                        filter_manager.mark_bought(market_equipment_id, \
-                                                   bought_ids)
-                        self._log('success',
-                                  f"Успешно куплено: {item_name} "
-                                  f"({market_equipment_id}). Куплено "
-                                  f"{filter_obj['bought']}/"
-                                  f"{filter_obj['quantity']}.")
-                        if filter_manager.is_current_filter_complete():
-                            self._log('success',
-                                      f"Задача для фильтра {filter_obj} "
-                                      f"выполнена. Куплено "
-                                      f"{filter_obj['bought']}/"
-                                      f"{filter_obj['quantity']}.",
-                                      emoji_key='success')
-                            # Raise here to break the inner loop and check
-                            # if all filters are done in the outer loop
-                            raise InvalidSession(
-                                f'Задача для фильтра {filter_obj} выполнена.')
-
-                    else:
-                        self._log('error',
-                                  f"Покупка не удалась: {item_name} "
-                                  f"({market_equipment_id})")
-        # No explicit return is needed here
+    async def _market_evaluate_stage(self, pipeline: MarketPipeline,
+                                     filter_manager: FilterManager,
+                                     bought_ids: set) -> None:
+        while True:
+            batch: MarketBatch = await pipeline.batches.get()
+            started = time()
+            try:
+                await self._analyze_items(batch, pipeline, filter_manager,
+                                          bought_ids)
+                if batch.timer is not None and batch.page_done:
+                    self._record_stream_page(batch.timer)
+            except Exception as e:
+                self._log('error', f"Ошибка анализа предметов: {e}",
+                          emoji_key='error')
+                self._log('debug', traceback.format_exc())
+            finally:
+                pipeline.evaluator.record(time() - started,
+                                          started - batch.created_at)
+                pipeline.batches.task_done()
+
+    async def _analyze_items(self, batch: MarketBatch,
+                             pipeline: MarketPipeline,
+                             filter_manager: FilterManager,
+                             bought_ids: set) -> None:
+        if batch.items:
+            self._log('debug', f"Анализ {len(batch.items)} предметов на "
+                               f"странице {batch.page}, фильтры: {batch.filters}")
+        matches = []
+        for item in batch.items:
+            for filter_obj in batch.filters:
+                candidate = self._match_item(item, filter_obj, batch, pipeline,
+                                             filter_manager, bought_ids)
+                if candidate is not None:
+                    matches.append(candidate)
+        # Best deals first, so balance and quota go to them, not to page order
+        matches.sort(key=lambda candidate: candidate.score, reverse=True)
+        for candidate in matches:
+            await self._dispatch_candidate(candidate, batch, pipeline,
+                                           filter_manager)
+
+    def _match_item(self, item: Dict, filter_obj: Dict, batch: MarketBatch,
+                    pipeline: MarketPipeline, filter_manager: FilterManager,
+                    bought_ids: set) -> Optional[BuyCandidate]:
+        if filter_manager.is_filter_complete(filter_obj):
+            return None
+        evaluation_result = self._item_evaluator.evaluate(item, filter_obj,
+                                                          bought_ids)
+        if not evaluation_result:
+            return None
+        item_name, market_equipment_id, price_tok = evaluation_result[:3]
+        stat_surplus = evaluation_result[5]
+        self._page_depth.record_match(
+            filter_manager.key_of(filter_obj) if batch.strategy == FILTER
+            else SUPERSET, batch.page)
+        if market_equipment_id:
+            self._scan_strategy.record_match(batch.strategy,
+                                             str(market_equipment_id))
+            self._filter_scheduler.record_detection(
+                filter_manager.key_of(filter_obj), str(market_equipment_id))
+        if (not market_equipment_id or market_equipment_id in bought_ids or
+                market_equipment_id in pipeline.pending):
+            return None
+        if self._claims and self._claims.is_claimed_by_other(
+                market_equipment_id, self.session_name):
+            self._log('debug', f"Лот {market_equipment_id} уже покупает "
+                               f"другая сессия. Пропускаю.")
+            return None
+        score = self._scorer.score(filter_obj, price_tok, stat_surplus,
+                                   self._item_evaluator.max_price(filter_obj))
+        return BuyCandidate(filter_obj, item_name, market_equipment_id,
+                            price_tok, score)
+
+    async def _dispatch_candidate(self, candidate: BuyCandidate,
+                                  batch: MarketBatch, pipeline: MarketPipeline,
+                                  filter_manager: FilterManager) -> None:
+        filter_obj = candidate.filter_obj
+        market_equipment_id = candidate.market_equipment_id
+        if market_equipment_id in pipeline.pending:
+            return
+        if (pipeline.pending_for(filter_obj) >=
+                filter_manager.remaining(filter_obj)):
+            return
+        if not self._balance_ledger.try_reserve(market_equipment_id,
+                                                candidate.price_tok):
+            self._log('debug', f"Недостаточно средств для "
+                               f"{candidate.item_name} ({market_equipment_id}) "
+                               f"за {candidate.price_tok:.1f} TOK. Доступно: "
+                               f"{self._balance_ledger.available:.1f} TOK")
+            return
+        self._log('debug', f"Пробую купить: {candidate.item_name} "
+                           f"({market_equipment_id}) за "
+                           f"{candidate.price_tok:.1f} TOK, оценка "
+                           f"{candidate.score:.2f}")
+        pipeline.pending[market_equipment_id] = filter_obj
+        await pipeline.buys.put(candidate)
+        if batch.timer is not None:
+            batch.timer.match_dispatched(time())
+
+    async def _market_buy_stage(self, pipeline: MarketPipeline,
+                                filter_manager: FilterManager,
+                                bought_ids: set) -> None:
+        while True:
+            candidate: BuyCandidate = await pipeline.buys.get()
+            started = time()
+            ok = attempted = False
+            try:
+                if filter_manager.is_filter_complete(candidate.filter_obj):
+                    continue
+                if self._claims and not await self._claims.try_claim(
+                        candidate.market_equipment_id, self.session_name):
+                    self._log('debug', f"Лот {candidate.market_equipment_id} "
+                                       f"уже захвачен другой сессией. "
+                                       f"Пропускаю.")
+                    continue
+                attempted = True
+                ok = await self.buy_equipment(candidate.market_equipment_id)
+                self._record_buy_result(ok, candidate, bought_ids,
+                                        filter_manager)
+            except Exception as e:
+                self._log('error', f"Критическая ошибка при покупке: {e}",
+                          emoji_key='error')
+                self._log('debug', traceback.format_exc())
+            finally:
+                self._balance_ledger.settle(candidate.market_equipment_id, ok,
+                                            attempted)
+                pipeline.pending.pop(candidate.market_equipment_id, None)
+                pipeline.buyer.record(time() - started,
+                                      started - candidate.created_at)
+                pipeline.buys.task_done()
 
 
     async def process_bot_logic(self) -> None:
@@ -815,7 +1626,11 @@ class MarketMonitorBot(BaseBot):
              expiration_time = datetime.fromtimestamp(self.access_token_created_time + self._token_live_time, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
              self._log('info', f"TG Web Data обновлены. Токен действует примерно до {expiration_time}", emoji_key='success')
 
-        await self.users_balance()
+        background_tasks = [
+            asyncio.create_task(self._balance_ledger.run_sync(
+                self.users_balance, settings.BALANCE_SYNC_INTERVAL)),
+            asyncio.create_task(self._purchase_history_loop()),
+        ]
 
         try:
             await self.debug_monitor_market()
@@ -826,6 +1641,10 @@ class MarketMonitorBot(BaseBot):
             sleep_duration = uniform(*ERROR_SLEEP_SECONDS)
             self._log('error', f"Неизвестная ошибка в process_bot_logic: {error}. Сон на {int(sleep_duration)}s.")
             self._log('debug', traceback.format_exc())
+            await asyncio.sleep(sleep_duration)
+        finally:
+            for task in background_tasks:
+                task.cancel()
 
 
 async def run_tapper(tg_client: UniversalTelegramClient):
@@ -15,10 +15,14 @@ GLOBAL_CONFIG_EXISTS = os.path.isdir(GLOBAL_CONFIG_PATH)
 CONFIG_PATH = os.path.join(GLOBAL_CONFIG_PATH, 'accounts_config.json') if GLOBAL_CONFIG_EXISTS else 'bot/config/accounts_config.json'
 SESSIONS_PATH = os.path.join(GLOBAL_CONFIG_PATH, 'sessions') if GLOBAL_CONFIG_EXISTS else 'sessions'
 PROXIES_PATH = os.path.join(GLOBAL_CONFIG_PATH, 'proxies.txt') if GLOBAL_CONFIG_EXISTS else 'bot/config/proxies.txt'
+DATA_PATH = os.path.join(GLOBAL_CONFIG_PATH, 'ton_kombat_market') if GLOBAL_CONFIG_EXISTS else 'data'
 
 if not os.path.exists(path=SESSIONS_PATH):
     os.mkdir(path=SESSIONS_PATH)
 
+if not os.path.exists(path=DATA_PATH):
+    os.mkdir(path=DATA_PATH)
+
 if settings.FIX_CERT:
     from certifi import where
     os.environ['SSL_CERT_FILE'] = where()
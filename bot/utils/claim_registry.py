@@ -0,0 +1,137 @@
+import asyncio
+import os
+import re
+import uuid
+from time import time
+from typing import Dict, Optional, Tuple
+
+import fasteners
+
+from bot.config import settings
+from bot.utils import DATA_PATH
+
+
+class PurchaseClaimRegistry:
+    def __init__(self, claims_dir: str, ttl: float):
+        self._dir = claims_dir
+        self._ttl = ttl
+        os.makedirs(self._dir, exist_ok=True)
+        self._file_lock = fasteners.InterProcessLock(
+            os.path.join(self._dir, 'claims.lock'))
+        # market_equipment_id -> (owner session, expires at)
+        self._local: Dict[str, Tuple[str, float]] = {}
+        self._next_purge = time() + ttl
+
+    def owner(self, market_equipment_id: str) -> Optional[str]:
+        claim = self._local.get(market_equipment_id)
+        if claim and claim[1] > time():
+            return claim[0]
+        return None
+
+    def is_claimed_by_other(self, market_equipment_id: str,
+                            session_name: str) -> bool:
+        owner = self.owner(market_equipment_id)
+        return owner is not None and owner != session_name
+
+    async def try_claim(self, market_equipment_id: str,
+                        session_name: str) -> bool:
+        now = time()
+        owner = self.owner(market_equipment_id)
+        if owner is not None:
+            return owner == session_name
+
+        # Reserve in-process before any await so that sessions of this
+        # process never reach the file system for the same listing together
+        expires_at = now + self._ttl
+        self._local[market_equipment_id] = (session_name, expires_at)
+        claimed, owner, expires_at = await asyncio.to_thread(
+            self._claim_file, market_equipment_id, session_name, now,
+            expires_at)
+        self._local[market_equipment_id] = (owner, expires_at)
+
+        if now >= self._next_purge:
+            self._next_purge = now + self._ttl
+            await asyncio.to_thread(self._purge, now)
+        return claimed
+
+    def _claim_path(self, market_equipment_id: str) -> str:
+        name = re.sub(r'[^\w-]', '_', str(market_equipment_id))
+        return os.path.join(self._dir, f"{name}.claim")
+
+    def _read_claim(self, path: str) -> Optional[Tuple[str, float]]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                owner, expires_at = f.read().split('\n')[:2]
+            return owner, float(expires_at)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Unreadable claim: held by an unknown owner for a full TTL
+            try:
+                return '', os.path.getmtime(path) + self._ttl
+            except FileNotFoundError:
+                return None
+
+    @staticmethod
+    def _create_claim(path: str, payload: str) -> bool:
+        # The claim is written to a private file and published with a hard
+        # link, so other processes never see it empty or half-written
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    def _claim_file(self, market_equipment_id: str, session_name: str,
+                    now: float, expires_at: float) -> Tuple[bool, str, float]:
+        path = self._claim_path(market_equipment_id)
+        payload = f"{session_name}\n{expires_at}"
+        if self._create_claim(path, payload):
+            return True, session_name, expires_at
+
+        with self._file_lock:
+            current = self._read_claim(path)
+            if current is None:
+                if self._create_claim(path, payload):
+                    return True, session_name, expires_at
+                current = self._read_claim(path) or ('', 0.0)
+            owner, owner_expires_at = current
+            if owner_expires_at > now and owner != session_name:
+                return False, owner, owner_expires_at
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        return True, session_name, expires_at
+
+    def _purge(self, now: float) -> None:
+        self._local = {key: claim for key, claim in self._local.items()
+                       if claim[1] > now}
+        with self._file_lock:
+            for entry in os.scandir(self._dir):
+                if not entry.name.endswith('.claim'):
+                    continue
+                claim = self._read_claim(entry.path)
+                if claim is not None and claim[1] <= now:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+
+_registry: Optional[PurchaseClaimRegistry] = None
+
+
+def get_claim_registry() -> Optional[PurchaseClaimRegistry]:
+    global _registry
+    if not settings.PURCHASE_CLAIMS:
+        return None
+    if _registry is None:
+        _registry = PurchaseClaimRegistry(
+            os.path.join(DATA_PATH, 'claims'), settings.PURCHASE_CLAIM_TTL)
+    return _registry
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from time import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from bot.config import settings
+from bot.utils import DATA_PATH, logger
+
+
+FLUSH_INTERVAL_SECONDS = 5
+FLUSH_BATCH_SIZE = 500
+RETENTION_CHECK_SECONDS = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    id TEXT PRIMARY KEY,
+    equipment_type TEXT,
+    rarity TEXT,
+    name TEXT,
+    price REAL,
+    first_seen INTEGER,
+    last_seen INTEGER
+);
+CREATE TABLE IF NOT EXISTS listing_stats (
+    listing_id TEXT,
+    slot INTEGER,
+    equipment_type TEXT,
+    rarity TEXT,
+    stat_type TEXT,
+    level INTEGER,
+    value REAL,
+    PRIMARY KEY (listing_id, slot)
+);
+CREATE TABLE IF NOT EXISTS polls (
+    minute INTEGER PRIMARY KEY
+);
+CREATE INDEX IF NOT EXISTS ix_listings_type_rarity
+    ON listings (equipment_type, rarity);
+CREATE INDEX IF NOT EXISTS ix_listings_last_seen ON listings (last_seen);
+CREATE INDEX IF NOT EXISTS ix_stats_type_rarity_stat_level
+    ON listing_stats (equipment_type, rarity, stat_type, level);
+"""
+
+
+def listing_fields(item: Dict) -> Tuple[str, str, str, List[Dict]]:
+    equipment = item.get('metadata', {}).get('equipment', {})
+    return (item.get('equipment_type') or equipment.get('type'),
+            item.get('rarity') or equipment.get('rarity'),
+            equipment.get('name'),
+            equipment.get('equipment_stats', []))
+
+
+class ObservationStore:
+    def __init__(self, path: str, retention_days: int):
+        self._path = path
+        self._retention_seconds = retention_days * 86400
+        self._buffer: Dict[str, Tuple[Dict, int]] = {}
+        # Minutes in which the market was polled: tells a quiet market from
+        # one that was not watched
+        self._poll_minutes: Set[int] = set()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript(SCHEMA)
+        self._writer: Optional[asyncio.Task] = None
+        self._next_retention = 0.0
+
+    def observe(self, items: List[Dict]) -> None:
+        now = int(time())
+        self._poll_minutes.add(now // 60)
+        for item in items:
+            market_equipment_id = item.get('id')
+            if market_equipment_id:
+                self._buffer[str(market_equipment_id)] = (item, now)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._run_writer())
+
+    async def _run_writer(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer and not self._poll_minutes:
+            return
+        batch, self._buffer = self._buffer, {}
+        minutes, self._poll_minutes = self._poll_minutes, set()
+        try:
+            await asyncio.to_thread(self._write, batch, minutes)
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось записать наблюдения рынка: {e}")
+
+    def _write(self, batch: Dict[str, Tuple[Dict, int]],
+               minutes: Set[int]) -> None:
+        listing_rows = []
+        stat_rows = []
+        for market_equipment_id, (item, seen_at) in batch.items():
+            equipment_type, rarity, name, stats = listing_fields(item)
+            price_tok = float(item.get('price_gross', 0)) / 1_000_000_000
+            listing_rows.append((market_equipment_id, equipment_type, rarity,
+                                 name, price_tok, seen_at, seen_at))
+            for slot, stat in enumerate(stats):
+                stat_rows.append((market_equipment_id, slot, equipment_type,
+                                  rarity, stat.get('type'),
+                                  int(stat.get('level', 0)), stat.get('value')))
+
+        with self._db_lock, self._conn:
+            for start in range(0, len(listing_rows), FLUSH_BATCH_SIZE):
+                self._conn.executemany(
+                    "INSERT INTO listings (id, equipment_type, rarity, name, "
+                    "price, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET price = excluded.price, "
+                    "last_seen = excluded.last_seen",
+                    listing_rows[start:start + FLUSH_BATCH_SIZE])
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO listing_stats (listing_id, slot, "
+                "equipment_type, rarity, stat_type, level, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", stat_rows)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO polls (minute) VALUES (?)",
+                [(minute,) for minute in minutes])
+
+            now = time()
+            if now >= self._next_retention:
+                self._next_retention = now + RETENTION_CHECK_SECONDS
+                self._apply_retention(now)
+
+    def _apply_retention(self, now: float) -> None:
+        cutoff = int(now - self._retention_seconds)
+        self._conn.execute(
+            "DELETE FROM listing_stats WHERE listing_id IN "
+            "(SELECT id FROM listings WHERE last_seen < ?)", (cutoff,))
+        self._conn.execute("DELETE FROM listings WHERE last_seen < ?", (cutoff,))
+        self._conn.execute("DELETE FROM polls WHERE minute < ?", (cutoff // 60,))
+
+    def query_prices(self, equipment_type: Optional[str], rarity: Optional[str],
+                     stat_type: str, min_level: int,
+                     since: float = 0) -> List[Tuple[float, int]]:
+        sql = ("SELECT l.price, l.first_seen FROM listing_stats s "
+               "JOIN listings l ON l.id = s.listing_id "
+               "WHERE s.stat_type = ? AND s.level >= ? AND l.last_seen >= ?")
+        params: list = [stat_type, min_level, int(since)]
+        if equipment_type and equipment_type != '*':
+            sql += " AND s.equipment_type = ?"
+            params.append(equipment_type)
+        if rarity:
+            sql += " AND s.rarity = ?"
+            params.append(rarity)
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def poll_minutes(self, since: float = 0) -> List[int]:
+        with self._db_lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT minute FROM polls WHERE minute >= ? ORDER BY minute",
+                (int(since) // 60,))]
+
+    def first_seen_times(self, since: float = 0) -> List[Tuple[int, str, str]]:
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT first_seen, equipment_type, rarity FROM listings "
+                "WHERE first_seen >= ? ORDER BY first_seen",
+                (int(since),)).fetchall()
+
+
+_store: Optional[ObservationStore] = None
+
+
+def get_observation_store() -> Optional[ObservationStore]:
+    global _store
+    if not settings.MARKET_OBSERVATIONS:
+        return None
+    if _store is None:
+        _store = ObservationStore(os.path.join(DATA_PATH, 'market.sqlite3'),
+                                  settings.MARKET_OBSERVATIONS_RETENTION_DAYS)
+    return _store
@@ -0,0 +1,60 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+class PurchaseHistoryStore:
+    def __init__(self, directory: str, session_name: str):
+        os.makedirs(directory, exist_ok=True)
+        self._entries_path = os.path.join(directory, f"{session_name}.jsonl")
+        self._cursor_path = os.path.join(directory, f"{session_name}.cursor")
+        self._cursor: Optional[str] = self._read_cursor()
+
+    @property
+    def cursor(self) -> Optional[str]:
+        return self._cursor
+
+    @staticmethod
+    def entry_id(item: Dict) -> str:
+        return str(item.get('id') or json.dumps(item, sort_keys=True))
+
+    def _read_cursor(self) -> Optional[str]:
+        try:
+            with open(self._cursor_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('newest_id')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def take_until_cursor(self, items: List[Dict]) -> Tuple[List[Dict], bool]:
+        # History pages are newest first
+        fresh = []
+        for item in items:
+            if self.entry_id(item) == self._cursor:
+                return fresh, True
+            fresh.append(item)
+        return fresh, False
+
+    def append(self, newest_first: List[Dict]) -> None:
+        if not newest_first:
+            return
+        with open(self._entries_path, 'a', encoding='utf-8') as f:
+            for item in reversed(newest_first):
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._cursor = self.entry_id(newest_first[0])
+        tmp_path = f"{self._cursor_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'newest_id': self._cursor}, f)
+        os.replace(tmp_path, self._cursor_path)
+
+    def entries(self) -> List[Dict]:
+        if not os.path.exists(self._entries_path):
+            return []
+        with open(self._entries_path, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def report(self) -> Tuple[int, float]:
+        entries = self.entries()
+        spent = sum(float(item.get('price_gross', 0)) for item in entries)
+        return len(entries), spent / 1_000_000_000
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+from time import time
+from typing import Dict, List, Set, Tuple
+
+from bot.utils import logger
+
+
+SUMMARY = 'summary'
+BUY = 'buy'
+
+
+class PurchaseLedger:
+    def __init__(self, path: str, fsync_every: int = 8,
+                 fsync_interval: float = 5.0):
+        self._path = path
+        self._fsync_every = fsync_every
+        self._fsync_interval = fsync_interval
+        self._unsynced = 0
+        self._entries = 0
+        self._file = None
+        self._sync_requested = asyncio.Event()
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+    @property
+    def entries(self) -> int:
+        return self._entries
+
+    def load(self) -> Tuple[Dict[str, int], Set[str]]:
+        progress: Dict[str, int] = {}
+        bought_ids: Set[str] = set()
+        self._entries = 0
+        if not os.path.exists(self._path):
+            return progress, bought_ids
+        with open(self._path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line after a crash
+                    continue
+                self._entries += 1
+                key = entry.get('filter')
+                if entry.get('type') == SUMMARY:
+                    progress[key] = progress.get(key, 0) + entry.get('count', 0)
+                    bought_ids.update(i for i, _ in entry.get('recent', []))
+                elif entry.get('id') not in bought_ids:
+                    progress[key] = progress.get(key, 0) + 1
+                    bought_ids.add(entry.get('id'))
+        return progress, bought_ids
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self._path, 'a', encoding='utf-8')
+        return self._file
+
+    def record(self, market_equipment_id: str, filter_key: str,
+               price_tok: float) -> None:
+        entry = {'type': BUY, 'id': market_equipment_id, 'filter': filter_key,
+                 'price': round(price_tok, 6), 'ts': int(time())}
+        f = self._open()
+        # Written to the OS right away so os.execv restarts never lose it;
+        # only fsync is batched
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        self._entries += 1
+        self._unsynced += 1
+        if self._unsynced >= self._fsync_every:
+            # fsync blocks; the flusher does it off the event loop
+            self._sync_requested.set()
+
+    def sync(self) -> None:
+        if self._file is None or not self._unsynced:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._sync_requested.wait(),
+                                           self._fsync_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._sync_requested.clear()
+                if self._file is None or not self._unsynced:
+                    continue
+                # Only the fsync runs in the worker thread; records are
+                # flushed when written and counted here on the event loop,
+                # so the ones written meanwhile stay unsynced
+                unsynced = self._unsynced
+                await asyncio.to_thread(os.fsync, self._file.fileno())
+                self._unsynced -= unsynced
+        finally:
+            self.close()
+
+    def compact(self, id_retention_seconds: float) -> None:
+        if not os.path.exists(self._path):
+            return
+        self.close()
+        now = time()
+        counts: Dict[str, int] = {}
+        recent: Dict[str, List[Tuple[str, int]]] = {}
+        seen: Set[str] = set()
+        with open(self._path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                key = entry.get('filter')
+                if entry.get('type') == SUMMARY:
+                    counts[key] = counts.get(key, 0) + entry.get('count', 0)
+                    purchases = [(i, ts) for i, ts in entry.get('recent', [])
+                                 if i not in seen]
+                else:
+                    if entry.get('id') in seen:
+                        continue
+                    counts[key] = counts.get(key, 0) + 1
+                    purchases = [(entry.get('id'), entry.get('ts', 0))]
+                for market_equipment_id, ts in purchases:
+                    seen.add(market_equipment_id)
+                    # Old listings never come back to the market, so their
+                    # ids are not needed for dedupe any more
+                    if now - ts < id_retention_seconds:
+                        recent.setdefault(key, []).append(
+                            (market_equipment_id, ts))
+
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, count in counts.items():
+                f.write(json.dumps({'type': SUMMARY, 'filter': key,
+                                    'count': count,
+                                    'recent': recent.get(key, [])}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+        self._entries = len(counts)
+        logger.info(f"Журнал покупок {os.path.basename(self._path)} сжат "
+                    f"до {len(counts)} записей")